@@ -0,0 +1,98 @@
+import os
+import re
+import requests
+from datetime import datetime, timedelta
+from manifest import Manifest
+from run_state import RunState, get_run_state_file
+
+
+class CatchUp():
+  """
+  Works out the days each source still has to process.
+
+  For every source the gap goes from the last day clipped (or published) for
+  all its variables to the latest day the source has available. The days of
+  the last lookback_days are checked too, so a day that failed in the middle
+  of the series is retried. A day is done when the run state reached
+  'clipped' or its clipped raster is in the output folder.
+  """
+
+  CHIRPS_URL = "https://data.chc.ucsb.edu/products/CHIRPS-2.0/global_daily/tifs/p05"
+  SOURCES = {"CHIRPS": ["PREC"], "ERA5": ["TMAX", "TMIN", "SRAD"]}
+
+  def __init__(self, output_path, era5_lag=8, lookback_days=31, timeout=60):
+    self.output_path = output_path
+    # AgERA5 se publica con unos días de retraso, no se consulta el CDS
+    self.era5_lag = era5_lag
+    self.lookback_days = lookback_days
+    self.timeout = timeout
+    self.run_state = RunState(get_run_state_file(self.output_path))
+    self.manifest = Manifest()
+
+  def chirps_latest_day(self, today):
+    # Último archivo del listado del año en curso, o del anterior a comienzos de año
+    for year in [today.year, today.year - 1]:
+      response = requests.get(f"{self.CHIRPS_URL}/{year}/", timeout=self.timeout)
+      if response.status_code == 404:
+        continue
+      response.raise_for_status()
+      days = re.findall(r"chirps-v2\.0\.(\d{4})\.(\d{2})\.(\d{2})\.tif\.gz", response.text)
+      if days:
+        return datetime(*map(int, max(days)))
+    return None
+
+  def era5_latest_day(self, today):
+    return datetime(today.year, today.month, today.day) - timedelta(days=self.era5_lag)
+
+  def latest_day(self, source, today):
+    if source == "CHIRPS":
+      return self.chirps_latest_day(today)
+    return self.era5_latest_day(today)
+
+  def done_days(self, source, variable):
+    # Días YYYYMMDD recortados según el estado de la corrida o la carpeta de salida
+    days = set(day for _, _, day, state, _ in self.run_state.days(source, variable)
+               if RunState.STATES.index(state) >= RunState.STATES.index("clipped"))
+    return days | self.manifest.dates(os.path.join(self.output_path, variable), pattern=rf"^{variable}_(\d{{8}})\.tif$")
+
+  def missing_days(self, source, today=None):
+    """
+    Returns the days (YYYY-MM-DD) of source that are not done yet, up to the
+    latest day available. An empty list means there is nothing new.
+    """
+    today = today or datetime.now()
+    latest = self.latest_day(source, today)
+    if latest is None:
+      print(f"\tThe latest day available of {source} could not be found")
+      return []
+
+    done = [self.done_days(source, variable) for variable in self.SOURCES[source]]
+    start = latest - timedelta(days=self.lookback_days - 1)
+    if all(done):
+      last = datetime.strptime(min(max(days) for days in done), "%Y%m%d")
+      start = min(start, last + timedelta(days=1))
+
+    missing = []
+    day = start
+    while day <= latest:
+      if not all(day.strftime("%Y%m%d") in days for days in done):
+        missing.append(day.strftime("%Y-%m-%d"))
+      day += timedelta(days=1)
+    return missing
+
+  def plan(self, sources=None, today=None):
+    # {source: días pendientes}, las fuentes al día no aparecen
+    plan = {}
+    for source in sources or self.SOURCES:
+      try:
+        days = self.missing_days(source, today)
+      except requests.exceptions.RequestException as e:
+        print(f"\tThe days available of {source} could not be read: {e}")
+        continue
+      if days:
+        plan[source] = days
+      print(f"\t{source}: {len(days)} days to process" + (f" ({days[0]} to {days[-1]})" if days else ""))
+    return plan
+
+  def close(self):
+    self.run_state.close()
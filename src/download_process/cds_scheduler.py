@@ -0,0 +1,145 @@
+import time
+import cdsapi
+from concurrent.futures import ThreadPoolExecutor
+from tools import Tools, Response
+
+
+class CdsJob():
+
+  def __init__(self, dataset, request, target, on_complete=None, on_error=None):
+    self.dataset = dataset
+    self.request = request
+    self.target = target
+    # Called with the downloaded target, e.g. to extract the zip
+    self.on_complete = on_complete
+    # Called with the error when the request, the download or on_complete fails
+    self.on_error = on_error
+
+    self.result = None
+    self.state = "pending"
+    self.error = None
+
+
+class CdsScheduler():
+  """
+  Submits many CDS requests at once, polls them together and downloads each
+  result as soon as it is completed, instead of waiting for every job in turn.
+
+  client_factory returns the client used to submit the requests, by default a
+  cdsapi.Client that does not wait for the jobs. Any object with the same
+  retrieve(dataset, request) -> result interface (result.update(),
+  result.reply["state"], result.download(target)) can be used instead.
+
+  A job is failed when the CDS reports any state other than the waiting ones
+  or completed (failed, dismissed, deleted...), and every job that is not
+  done max_wait seconds after the run started is failed too.
+  """
+
+  # Estados del CDS de una solicitud que todavía no termina
+  WAITING_STATES = ("accepted", "queued", "running")
+
+  def __init__(self, client_factory=None, max_requests=8, download_workers=2, poll_interval=30, timeout=600, max_wait=12 * 3600):
+    self.client_factory = client_factory if client_factory is not None else lambda: cdsapi.Client(timeout=timeout, wait_until_complete=False)
+    self.max_requests = max_requests
+    self.download_workers = download_workers
+    self.poll_interval = poll_interval
+    self.max_wait = max_wait
+
+  def fail(self, job, error):
+    job.state = "failed"
+    job.error = str(error)
+    if job.on_error is not None:
+      try:
+        job.on_error(job.error)
+      except Exception as callback_error:
+        print(f"\tError recording the failure of {job.target}: {callback_error}")
+
+  def submit(self, client, job):
+    try:
+      job.result = client.retrieve(job.dataset, job.request)
+      job.state = "submitted"
+      print(f"\tRequest submitted: {job.target}")
+    except Exception as error:
+      self.fail(job, error)
+      print(f"\tRequest failed: {job.target} -> {job.error}")
+
+  def poll(self, job):
+    try:
+      job.result.update()
+      state = job.result.reply["state"]
+    except Exception as error:
+      self.fail(job, error)
+      return job.state
+
+    if state == "completed":
+      job.state = "completed"
+    elif state not in self.WAITING_STATES:
+      self.fail(job, job.result.reply.get("error") or f"CDS request {state}")
+    return job.state
+
+  def download(self, job):
+    try:
+      # El zip se descarga a un temporal, un zip incompleto nunca tiene el nombre final
+      with Tools().atomic_path(job.target) as tmp_target:
+        job.result.download(tmp_target)
+      if job.on_complete is not None:
+        job.on_complete(job.target)
+      job.state = "downloaded"
+      return Response(res=job.target)
+    except Exception as error:
+      self.fail(job, error)
+      return Response(error=job.error)
+
+  def run(self, jobs):
+    """
+    Runs every job keeping at most max_requests of them queued in the CDS.
+    Returns the jobs with their final state and error.
+    """
+    client = self.client_factory()
+    pending = list(jobs)
+    active = []
+    downloads = []
+    deadline = time.time() + self.max_wait
+
+    with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+      while pending or active:
+        if time.time() > deadline:
+          # Las solicitudes que siguen en cola o sin enviar no se esperan más
+          for job in active + pending:
+            self.fail(job, f"CDS request not completed after {self.max_wait}s")
+            print(f"\tRequest failed: {job.target} -> {job.error}")
+          break
+
+        while pending and len(active) < self.max_requests:
+          job = pending.pop(0)
+          self.submit(client, job)
+          if job.state == "submitted":
+            active.append(job)
+
+        for job in list(active):
+          state = self.poll(job)
+          if state == "completed":
+            active.remove(job)
+            print(f"\tRequest completed: {job.target}")
+            downloads.append(executor.submit(self.download, job))
+          elif state == "failed":
+            active.remove(job)
+            print(f"\tRequest failed: {job.target} -> {job.error}")
+
+        if active:
+          time.sleep(max(0, min(self.poll_interval, deadline - time.time())))
+
+      for download in downloads:
+        download.result()
+
+    self.summary(jobs)
+    return jobs
+
+  def summary(self, jobs):
+    failed = [job for job in jobs if job.state != "downloaded"]
+
+    print(f"\tCDS requests downloaded: {len(jobs) - len(failed)} of {len(jobs)}")
+    for job in failed:
+      print(f"\tFailed: {job.target} -> {job.error}")
+
+    return failed
@@ -1,18 +1,20 @@
 import os
-import urllib.request
 import gzip
-import geopandas as gpd
+import shutil
 import rasterio
-import numpy as np
-from concurrent.futures import ThreadPoolExecutor
-from rasterio.mask import mask
-from shapely.geometry import mapping
-from tools import DownloadProgressBar, Tools
+from rasterio.errors import RasterioIOError
+from tools import Tools, Response
+from downloader import Downloader
+from clip_plan import ClipPlan
+from manifest import Manifest
+from datacube import DataCube
+from run_state import RunState, get_run_state_file
+from clip_pool import ClipPool, clip_dataset, clip_raster_file
 
 
 class ChirpsData():
 
-  def __init__(self, output_path, country, start_date, end_date, download_data_path):
+  def __init__(self, output_path, country, start_date, end_date, download_data_path, stream=False, keep_global=False, workers=4, cube=False, days=None, processes=1, shard=None):
      
     self.output_path = output_path
     self.download_data_path = download_data_path
@@ -20,8 +22,17 @@ class ChirpsData():
     self.start_date = start_date
     self.end_date = end_date
 
+    # days: only these days (YYYY-MM-DD) of the range are downloaded, all of them by default
+    self.days = set(days) if days is not None else None
+
+    # stream: download, decompress and clip every file in a single pass
+    # keep_global: keep the global .tif after it was clipped (only used with stream)
+    self.stream = stream
+    self.keep_global = keep_global
+
     self.tools = Tools()
-    self.cores = 4
+    self.cores = workers
+    self.downloader = Downloader(workers=self.cores)
 
     self.project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
     self.shapefile_path = os.path.join(self.project_root,"shapefiles")
@@ -42,93 +53,175 @@ class ChirpsData():
 
     self.CHIRPS_URL = "https://data.chc.ucsb.edu/products/CHIRPS-2.0/global_daily/tifs/p05/year"
     self.CHIRPS_FILE = "chirps-v2.0.date.tif.gz"
+    self.CHUNK_SIZE = 1024 * 1024
+
+    # Window and mask of the country, computed once for the CHIRPS grid
+    self.clip_plan = ClipPlan(self.country_path, os.path.join(self.downloaded_data_path, "clip_plans"))
+
+    # Processes used to clip the downloaded rasters, one runs the clips in this process
+    self.pool = ClipPool(self.clip_plan, processes)
+
+    # Index of the files of the data directories, listed once per run
+    self.manifest = Manifest(os.path.join(self.chirps_path, "manifest.json"))
+
+    # Optional per-variable datacube next to the GeoTIFFs
+    self.cube = DataCube(os.path.join(self.output_path, "cube"), self.country) if cube else None
+
+    # Estado de cada día (descarga, conversión, recorte), compartido con las otras etapas
+    # Con shard (i, N) cada nodo usa su propia base, no se comparte SQLite entre nodos
+    self.run_state = RunState(get_run_state_file(self.output_path, shard))
 
     pass
 
+  def get_day(self, path):
+    # PREC_20240701.tif -> 20240701
+    return os.path.splitext(os.path.basename(self.get_output_file(path)))[0].split("_")[1]
+
   
   def download_file(self, url, path, remove = True):
-    if os.path.exists(path.replace('.gz','')) == False:
-        if os.path.exists(path.replace('.gz','')):
-          os.remove(path.replace('.gz',''))
-        with DownloadProgressBar(unit='B', unit_scale=True,miniters=1, desc=url.split('/')[-1]) as t:
-          urllib.request.urlretrieve(url, filename=path, reporthook=t.update_to)
-        with gzip.open(path, 'rb') as f_in:
-          with open(path.replace('.gz',''), 'wb') as f_out:
-          # Read the compressed content and write it to the output file
-            f_out.write(f_in.read())
+    if self.manifest.exists(path.replace('.gz','')) == False:
+        result = self.downloader.download(url, path)
+        if result.error is not None:
+          self.run_state.fail("CHIRPS", "PREC", self.get_day(path), result.error)
+          return result
+        self.run_state.set("CHIRPS", "PREC", self.get_day(path), "downloaded")
+        self.decompress_file(path)
+        self.manifest.add(path.replace('.gz',''))
         os.remove(path)
     else:
         print("\tFile already downloaded!",path)
+    self.run_state.set("CHIRPS", "PREC", self.get_day(path), "converted")
+    return Response(res=path.replace('.gz',''))
+
+  def decompress_file(self, path):
+    # Decompress in chunks so the global raster is never held in memory
+    with gzip.open(path, 'rb') as f_in, self.tools.atomic_path(path.replace('.gz','')) as tmp_path:
+      with open(tmp_path, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, self.CHUNK_SIZE)
+
+  def get_output_file(self, raster_path):
+    # chirps-v2.0.2024.07.01.tif -> PREC_20240701.tif
+    name, extension = os.path.basename(raster_path).replace(".gz", "").replace("chirps-v2.0.", "PREC_").rsplit(".", 1)
+    return os.path.join(self.chirps_output_path, f"{name.replace('.', '')}.{extension}")
+
+  def clip_raster(self, src, output_file):
+    out_image, out_transform = clip_dataset(self.clip_plan, src, output_file)
+    self.record_clip(output_file, (out_image[0], out_transform, src.crs))
+
+  def record_clip(self, output_file, image):
+    # Registro de un raster recortado, siempre en este proceso aunque se haya recortado en un worker
+    self.manifest.add(output_file)
+    self.run_state.set("CHIRPS", "PREC", self.get_day(output_file), "clipped")
+
+    if self.cube is not None:
+      self.cube.append_raster(output_file, *image)
+
+  def download_and_clip(self, url, path):
+    output_file = self.get_output_file(path)
+    if self.manifest.exists(output_file):
+      print("\tFile already clipped!", output_file)
+      self.run_state.set("CHIRPS", "PREC", self.get_day(path), "clipped")
+      return Response(res=output_file)
+
+    global_file = path.replace('.gz','')
+    if not self.manifest.exists(global_file):
+      result = self.downloader.download(url, path)
+      if result.error is not None:
+        self.run_state.fail("CHIRPS", "PREC", self.get_day(path), result.error)
+        return result
+      self.run_state.set("CHIRPS", "PREC", self.get_day(path), "downloaded")
+
+      if self.keep_global:
+        self.decompress_file(path)
+        self.manifest.add(global_file)
+        os.remove(path)
+      else:
+        # GDAL decompresses the stream on the fly, the global .tif is never written
+        global_file = f"/vsigzip/{path}"
+
+    try:
+      with rasterio.open(global_file) as src:
+        self.clip_raster(src, output_file)
+    except RasterioIOError as error:
+      self.run_state.fail("CHIRPS", "PREC", self.get_day(path), error)
+      return Response(error=str(error))
+    finally:
+      if os.path.exists(path):
+        os.remove(path)
+    return Response(res=output_file)
 
-  def downloadData(self):
-      
+  def get_urls(self):
     dates = self.tools.generate_dates(self.start_date, self.end_date)
+    if self.days is not None:
+      dates = [date for date in dates if date in self.days]
 
     urls = [f"{self.CHIRPS_URL.replace('year', date.split('-')[0])}/{self.CHIRPS_FILE.replace('date',date.replace('-','.'))}" for date in dates]
     files = [os.path.basename(url) for url in urls]
     save_path_chirp_all = [os.path.join(self.prec_path, file) for file in files]
+    return urls, save_path_chirp_all
 
-    # Download in parallel
-    with ThreadPoolExecutor(max_workers=self.cores) as executor:
-      executor.map(self.download_file, urls, save_path_chirp_all)
-
-    return save_path_chirp_all
+  def downloadData(self):
       
-  def cutRasters(self, rasters_path):
+    urls, save_path_chirp_all = self.get_urls()
 
-    # Abrir el shapefile
-    shapefile = gpd.read_file(self.country_path)
-    # Convertir el shapefile a una lista de geometrías
-    shapes = [feature["geometry"] for feature in shapefile.__geo_interface__["features"]]
-    # Convertir el shapefile a una lista de geometrías
-    shapes = [mapping(geom) for geom in shapefile.geometry]
+    # Download in parallel
+    results = self.downloader.run(self.download_file, urls, save_path_chirp_all)
+    self.downloader.summary(urls, results)
 
-    for raster in rasters_path:
+    # Only the files that were downloaded are clipped
+    return [result.res for result in results if result.error is None]
 
-      raster_path = raster.replace(".gz", "")
+  def streamData(self):
 
-      # Abrir el raster
-      with rasterio.open(raster_path) as src:
+    urls, save_path_chirp_all = self.get_urls()
 
-        if shapefile.crs != src.crs:
-          shapefile = shapefile.to_crs(src.crs)
-        
-        # Recortar el raster con el shapefile
-        out_image, out_transform = mask(src, shapes, crop=True)
-        if src.nodata is not None:
-          nodata = src.nodata
-          out_image[out_image == nodata] = np.nan
+    # Download, decompress and clip in parallel
+    results = self.downloader.run(self.download_and_clip, urls, save_path_chirp_all)
+    self.downloader.summary(urls, results)
 
-        invalid_value = -9999
-        invalid_mask = (out_image == invalid_value)
-        if np.any(invalid_mask):
-          print("Hay valores -9999 en los datos recortados. Reemplazando con np.nan.")
-          out_image[invalid_mask] = np.nan
- 
-        out_meta = src.meta.copy()
+    return [result.res for result in results if result.error is None]
+      
+  def cutRasters(self, rasters_path):
 
-        # Actualizar los metadatos del raster recortado
-        out_meta.update({
-            "driver": "GTiff",
-            "height": out_image.shape[1],
-            "width": out_image.shape[2],
-            "transform": out_transform
-        })
+    tasks = []
+    for raster in rasters_path:
+
+      raster_path = raster.replace(".gz", "")
 
-        # Guardar el raster recortado
+      # Los días ya recortados en una corrida anterior no se repiten
+      output_file = self.get_output_file(raster_path)
+      if self.manifest.exists(output_file) and self.run_state.reached("CHIRPS", "PREC", self.get_day(raster_path), "clipped"):
+        continue
+
+      tasks.append((raster_path, output_file, self.cube is not None))
+
+    # Los recortes se reparten entre los procesos, los resultados llegan en orden,
+    # si uno falla es la siguiente tarea sin resultado
+    done = 0
+    try:
+      for output_file, image in self.pool.map(clip_raster_file, tasks):
+        self.record_clip(output_file, image)
+        done += 1
+    except Exception as error:
+      for task in tasks[done:done + 1]:
+        self.run_state.fail("CHIRPS", "PREC", self.get_day(task[1]), error)
+      raise
 
-        raster_cut = os.path.join(self.chirps_output_path, os.path.basename(raster_path).replace("chirps-v2.0.", "PREC_"))
-        name, extension = os.path.basename(raster_cut).rsplit(".", 1)
-        name = name.replace(".", "")
-        new_file_name = f"{name}.{extension}"
+  def main(self):
 
-        with rasterio.open(raster_cut.replace(os.path.basename(raster_cut), new_file_name), "w", **out_meta) as dest:
-          dest.write(out_image)
+    try:
+      self.run()
+    finally:
+      self.downloader.close()
+      self.pool.close()
+      self.manifest.save()
+      self.run_state.close()
 
+  def run(self):
 
+    if self.stream:
+      self.streamData()
+      return
 
-    
-  def main(self):
-      
     rasters_path = self.downloadData()
     self.cutRasters(rasters_path)
\ No newline at end of file
@@ -0,0 +1,130 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import geopandas as gpd
+from affine import Affine
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from shapely.geometry import mapping
+
+
+class Grid():
+  """
+  Georeferencing of an in-memory array, exposes the attributes of a rasterio
+  dataset that are needed to build a ClipPlan.
+  """
+
+  def __init__(self, transform, height, width, crs):
+    self.transform = transform
+    self.height = height
+    self.width = width
+    self.shape = (height, width)
+    self.crs = crs
+    self.res = (abs(transform.a), abs(transform.e))
+
+  def window_transform(self, window):
+    return window_transform(window, self.transform)
+
+
+class ClipPlan():
+  """
+  Crop window and boolean mask of a country shapefile over a raster grid.
+
+  Rasterizing the country polygons is done once per grid (transform, shape, CRS)
+  and reused for every raster sharing that grid, so each clip is a windowed read
+  plus an array mask. Plans can be saved in cache_path to be reused between runs.
+  """
+
+  def __init__(self, country_path, cache_path=None):
+    self.country_path = country_path
+    self.cache_path = cache_path
+    self.shapefile = None
+    self.plans = {}
+    self.lock = threading.Lock()
+
+    if self.cache_path is not None:
+      os.makedirs(self.cache_path, exist_ok=True)
+
+  def shapefile_signature(self):
+    # Changes when any file of the shapefile is replaced
+    if os.path.isdir(self.country_path):
+      files = [os.path.join(self.country_path, f) for f in sorted(os.listdir(self.country_path))]
+    else:
+      files = [self.country_path]
+    return repr([(os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)) for f in files])
+
+  def get_key(self, src):
+    return (tuple(src.transform)[:6], src.height, src.width, src.crs.to_string() if src.crs else None, os.path.abspath(self.country_path))
+
+  def get_cache_file(self, key):
+    digest = hashlib.sha1(f"{key}{self.shapefile_signature()}".encode("utf-8")).hexdigest()
+    return os.path.join(self.cache_path, f"{digest}.npz")
+
+  def get_shapes(self, crs):
+    if self.shapefile is None:
+      self.shapefile = gpd.read_file(self.country_path)
+    shapefile = self.shapefile
+    # Reproyectar el shapefile si el CRS es diferente al del raster
+    if crs is not None and shapefile.crs != crs:
+      shapefile = shapefile.to_crs(crs)
+    return [mapping(geom) for geom in shapefile.geometry]
+
+  def compute(self, src):
+    shape_mask, transform, window = raster_geometry_mask(src, self.get_shapes(src.crs), crop=True)
+    return {"window": window, "mask": shape_mask, "transform": transform}
+
+  def load(self, cache_file):
+    data = np.load(cache_file)
+    row_off, col_off, height, width = data["window"]
+    return {"window": Window(col_off, row_off, width, height),
+            "mask": data["mask"],
+            "transform": Affine(*data["transform"])}
+
+  def save(self, cache_file, plan):
+    window = plan["window"]
+    # Varios procesos pueden calcular el mismo plan a la vez, cada uno usa su temporal
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_file,
+             window=np.array([window.row_off, window.col_off, window.height, window.width]),
+             mask=plan["mask"],
+             transform=np.array(tuple(plan["transform"])[:6]))
+    os.replace(tmp_file, cache_file)
+
+  def get(self, src):
+    key = self.get_key(src)
+
+    with self.lock:
+      if key not in self.plans:
+        cache_file = self.get_cache_file(key) if self.cache_path is not None else None
+        if cache_file is not None and os.path.exists(cache_file):
+          self.plans[key] = self.load(cache_file)
+        else:
+          self.plans[key] = self.compute(src)
+          if cache_file is not None:
+            self.save(cache_file, self.plans[key])
+      return self.plans[key]
+
+  def clip(self, src):
+    """
+    Same result as rasterio.mask.mask(src, shapes, crop=True): pixels outside the
+    country are filled with the raster nodata (or 0).
+
+    Returns the clipped array (bands, rows, cols) and its transform.
+    """
+    plan = self.get(src)
+    out_image = src.read(window=plan["window"])
+    out_image[:, plan["mask"]] = src.nodata if src.nodata is not None else 0
+    return out_image, plan["transform"]
+
+  def clip_array(self, array, transform, crs, nodata=None):
+    """
+    Clip an in-memory array (bands, rows, cols) georeferenced by transform and crs.
+    Pixels outside the country are filled with nodata (or 0).
+    """
+    plan = self.get(Grid(transform, array.shape[-2], array.shape[-1], crs))
+    rows, cols = plan["window"].toslices()
+    out_image = array[:, rows, cols].copy()
+    out_image[:, plan["mask"]] = nodata if nodata is not None else 0
+    return out_image, plan["transform"]
@@ -0,0 +1,140 @@
+import threading
+import multiprocessing
+import numpy as np
+import rasterio
+import xarray as xr
+import rioxarray
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from clip_plan import ClipPlan
+from tools import Tools
+
+
+# ClipPlans of this process by (shapefile, cache), each worker opens the shapefile once
+clip_plans = {}
+
+
+def get_clip_plan(plan_key):
+  if plan_key not in clip_plans:
+    clip_plans[plan_key] = ClipPlan(*plan_key)
+  return clip_plans[plan_key]
+
+
+def init_worker(country_path, cache_path):
+  get_clip_plan((country_path, cache_path))
+
+
+def transform_values(xds, transform, value):
+  # Unit conversion of the variable (K -> °C, J m-2 -> MJ m-2)
+  # AgERA5 es float32, el resultado se fuerza a float32 porque la promoción de
+  # numpy no es la misma en todos los hilos y un mosaico no admite tipos mezclados
+  if transform == "-":
+    xds = xds - np.float32(value)
+  elif transform == "/":
+    xds = xds / np.float32(value)
+  if isinstance(xds, xr.Dataset):
+    # Dataset.astype cambia el orden de las variables, convert_netcdf las toma por posición
+    return xds.assign({name: xds[name].astype(np.float32) for name in xds.data_vars})
+  return xds.astype(np.float32)
+
+
+def clip_dataset(clip_plan, src, output_file):
+  """
+  Clips an open raster to the country and writes it to output_file.
+  Nodata and -9999 are stored as NaN. Returns the clipped array and transform.
+  """
+  # Recortar el raster con el shapefile, solo se lee la ventana del pais
+  out_image, out_transform = clip_plan.clip(src)
+  if src.nodata is not None:
+    nodata = src.nodata
+    out_image[out_image == nodata] = np.nan
+
+  invalid_value = -9999
+  invalid_mask = (out_image == invalid_value)
+  if np.any(invalid_mask):
+    print("Hay valores -9999 en los datos recortados. Reemplazando con np.nan.")
+    out_image[invalid_mask] = np.nan
+
+  out_meta = src.meta.copy()
+
+  # Actualizar los metadatos del raster recortado
+  out_meta.update({
+      "driver": "GTiff",
+      "height": out_image.shape[1],
+      "width": out_image.shape[2],
+      "transform": out_transform
+  })
+
+  # Guardar el raster recortado
+  with Tools().atomic_path(output_file) as tmp_file:
+    with rasterio.open(tmp_file, "w", **out_meta) as dest:
+      dest.write(out_image)
+  return out_image, out_transform
+
+
+def clip_raster_file(plan_key, raster_path, output_file, keep_image=False):
+  # Tarea de un worker: recorta un raster, la imagen solo se devuelve si el padre la necesita (datacube)
+  with rasterio.open(raster_path) as src:
+    out_image, out_transform = clip_dataset(get_clip_plan(plan_key), src, output_file)
+    image = (out_image[0], out_transform, src.crs) if keep_image else None
+  return output_file, image
+
+
+def convert_netcdf(plan_key, input_file, output_file, transform, value):
+  # Tarea de un worker: convierte un NetCDF diario de AgERA5 a .tif
+  new_crs = '+proj=longlat +datum=WGS84 +no_defs'
+  with xr.open_dataset(input_file) as xds:
+    xds = transform_values(xds, transform, value)
+    xds.rio.write_crs(new_crs, inplace=True)
+    variable_names = list(xds.variables)
+    with Tools().atomic_path(output_file) as tmp_file:
+      xds[variable_names[3]].rio.to_raster(tmp_file)
+  return output_file, None
+
+
+class ClipPool():
+  """
+  Runs the CPU-bound clip and conversion tasks of a stage in a process pool.
+
+  Every worker builds the ClipPlan of the country once and reuses it for all
+  its tasks. Results come back in the order of the tasks, so what the parent
+  does with them (manifest, run state, datacube) happens in the same order as
+  in a serial run. With one process the tasks run in the calling process.
+  The workers are started with the first task and kept until close().
+  """
+
+  def __init__(self, clip_plan, processes=1):
+    self.clip_plan = clip_plan
+    self.processes = processes
+    self.plan_key = (clip_plan.country_path, clip_plan.cache_path)
+    self.executor = None
+    self.lock = threading.Lock()
+
+  def get_executor(self):
+    # spawn: los workers no heredan los hilos ni las conexiones del proceso padre
+    with self.lock:
+      if self.executor is None:
+        self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=init_worker, initargs=self.plan_key)
+      return self.executor
+
+  def map(self, function, tasks):
+    """
+    Yields function(*task) for every task, in order. The functions must be
+    defined at module level and take the plan key as first argument.
+    """
+    function = partial(function, self.plan_key)
+    if self.processes <= 1 or len(tasks) <= 1:
+      clip_plans.setdefault(self.plan_key, self.clip_plan)
+      for task in tasks:
+        yield function(*task)
+      return
+
+    chunksize = max(1, len(tasks) // (self.processes * 4))
+    yield from self.get_executor().map(function, *zip(*tasks), chunksize=chunksize)
+
+  def close(self):
+    with self.lock:
+      if self.executor is not None:
+        self.executor.shutdown()
+        self.executor = None
@@ -1,87 +1,213 @@
 import os
+import shutil
+import threading
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
 import rasterio
-import calendar
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+from tools import Tools
+from datacube import DataCube
 
 class DataExtractor:
-  def __init__(self, output_path, csv_path, start_date, end_date):
+  def __init__(self, output_path, csv_path, start_date, end_date, country=None, cube=False, incremental=False, output_format="csv",
+               sampling="nearest", buffer_cells=1):
     self.output_path = output_path
     self.csv_path = csv_path
     self.start_date = start_date
     self.end_date = end_date
 
+    # Con cube se leen las series de los datacubes en vez de los rasters diarios
+    self.cube = DataCube(os.path.join(self.output_path, "cube"), country) if cube else None
+
+    # Series ya extraídas por variable, permite extraer cada fuente apenas termina
+    self.extracted = {}
+    self.outside = {}
+    self.lock = threading.Lock()
+
+    # Con incremental los días extraídos se combinan con los CSV existentes
+    self.incremental = incremental
+
+    # csv: un archivo por estación, parquet: un solo dataset particionado por año y mes
+    self.output_format = output_format
+    self.parquet_path = os.path.join(self.output_path, "stations_daily")
+
+    # nearest: celda del punto, bilinear: 4 centros vecinos, buffer: media de (2 * buffer_cells + 1)² celdas
+    self.sampling = sampling
+    self.buffer_cells = buffer_cells
+    # Celdas y pesos de los puntos por grilla, se calculan una sola vez
+    self.weights = {}
+
+    self.tools = Tools()
+
+    # Columna de salida -> carpeta y prefijo de los rasters recortados
+    self.variables = {
+        't_max': 'TMAX',
+        't_min': 'TMIN',
+        'prec': 'PREC',
+        'sol_rad': 'SRAD'
+    }
+
   def read_coordinates(self):
     # Leer el CSV con las coordenadas
     coords_df = pd.read_csv(self.csv_path)
     return coords_df
 
-  def extract_raster_data(self, start_date, end_date, lon, lat):
-    # Convertir las fechas en objetos de fecha para facilitar el manejo
-    start_year = int(start_date.split('-')[0])
-    start_month = int(start_date.split('-')[1])
-    end_year = int(end_date.split('-')[0])
-    end_month = int(end_date.split('-')[1])
-    
+  def get_weights(self, transform, height, width, lons, lats):
+    """
+    Calcula las celdas vecinas de cada punto y sus pesos según el método de
+    muestreo. Se calcula una vez por grilla y se reutiliza para todos los días.
+
+    Returns the rows, cols and weights arrays (points, neighbors) and the
+    boolean mask of the points that fall inside the grid. Neighbors outside
+    the grid have weight 0.
+    """
+    key = (tuple(transform)[:6], height, width, lons.tobytes(), lats.tobytes())
+    if key in self.weights:
+      return self.weights[key]
+
+    rows, cols = rowcol(transform, lons, lats)
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+    if self.sampling == "bilinear":
+      # Posición continua del punto respecto a los centros de las celdas
+      x = (lons - transform.c) / transform.a - 0.5
+      y = (lats - transform.f) / transform.e - 0.5
+      col0, row0 = np.floor(x).astype(int), np.floor(y).astype(int)
+      fx, fy = x - col0, y - row0
+      neighbor_rows = np.stack([row0, row0, row0 + 1, row0 + 1], axis=1)
+      neighbor_cols = np.stack([col0, col0 + 1, col0, col0 + 1], axis=1)
+      weights = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=1)
+    elif self.sampling == "buffer":
+      offsets = np.arange(-self.buffer_cells, self.buffer_cells + 1)
+      row_offsets, col_offsets = np.meshgrid(offsets, offsets, indexing="ij")
+      neighbor_rows = rows[:, None] + row_offsets.ravel()
+      neighbor_cols = cols[:, None] + col_offsets.ravel()
+      weights = np.ones(neighbor_rows.shape)
+    else:
+      neighbor_rows, neighbor_cols = rows[:, None], cols[:, None]
+      weights = np.ones(neighbor_rows.shape)
+
+    valid = (neighbor_rows >= 0) & (neighbor_rows < height) & (neighbor_cols >= 0) & (neighbor_cols < width) & inside[:, None]
+    weights = np.where(valid, weights, 0).astype(np.float32)
+
+    self.weights[key] = (np.clip(neighbor_rows, 0, height - 1), np.clip(neighbor_cols, 0, width - 1), weights, inside)
+    return self.weights[key]
+
+  def apply_weights(self, values, weights):
+    """
+    Combina los valores (days, points, neighbors) con los pesos (points, neighbors)
+    en un solo producto. Los vecinos sin dato (NaN) no cuentan y los pesos
+    restantes se normalizan.
+    """
+    valid = ~np.isnan(values)
+    active = np.where(valid, weights, 0)
+    total = active.sum(axis=-1)
+    weighted = np.einsum("dpk,dpk->dp", np.where(valid, values, 0), active)
+    with np.errstate(invalid="ignore", divide="ignore"):
+      return np.where(total > 0, weighted / total, np.nan).astype(np.float32)
+
+  def sample_raster(self, raster_path, lons, lats):
+    """
+    Lee los valores de las celdas vecinas de cada punto en un solo paso vectorizado.
+
+    Returns the values (points, neighbors), NaN on nodata, plus the weights and
+    the boolean mask of the points that fall inside the raster.
+    """
+    with rasterio.open(raster_path) as src:
+      rows, cols, weights, inside = self.get_weights(src.transform, src.height, src.width, lons, lats)
+      values = np.full(weights.shape, np.nan, dtype=np.float32)
+      used = weights > 0
+
+      if np.any(used):
+        # Solo se lee la ventana que contiene las celdas usadas
+        row_min, row_max = rows[used].min(), rows[used].max()
+        col_min, col_max = cols[used].min(), cols[used].max()
+        window = Window(col_min, row_min, col_max - col_min + 1, row_max - row_min + 1)
+        band = src.read(1, window=window)
+        values[used] = band[rows[used] - row_min, cols[used] - col_min]
+
+        if src.nodata is not None:
+          values[values == src.nodata] = np.nan
+
+    return values, weights, inside
+
+  def sample_cube(self, folder, date_strs, lons, lats):
+    # Igual que sample_raster pero con las series del datacube: (days, points, neighbors)
+    transform, height, width = self.cube.grid(folder)
+    rows, cols, weights, inside = self.get_weights(transform, height, width, lons, lats)
+    values = np.full((len(date_strs),) + weights.shape, np.nan, dtype=np.float32)
+    used = weights > 0
+
+    # Cada celda se lee una sola vez aunque la compartan varios puntos
+    cells, index = np.unique(np.stack([rows[used], cols[used]], axis=1), axis=0, return_inverse=True)
+    if len(cells) > 0:
+      series = self.cube.read_cells(folder, date_strs, cells[:, 0], cells[:, 1])
+      values[:, used] = series[:, index.ravel()]
+
+    return values, weights, inside
+
+  def extract_raster_data(self, start_date, end_date, lons, lats, variables=None):
+    """
+    Extrae las series diarias de todos los puntos abriendo cada raster una sola vez.
+    variables limits the extraction to those output columns (all by default).
+
+    Returns a dict with the 'day', 'month' and 'year' lists and, for each
+    variable, an array (days, points), plus a dict with the mask of the points
+    outside the grid of each variable.
+    """
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    dates = self.tools.generate_dates(start_date, end_date)
+
     data = {
-        'day': [],
-        'month': [],
-        'year': [],
-        't_max': [],
-        't_min': [],
-        'prec': [],
-        'sol_rad': []
+        'day': [int(date[8:10]) for date in dates],
+        'month': [int(date[5:7]) for date in dates],
+        'year': [int(date[0:4]) for date in dates]
     }
+    outside = {}
 
-    # Iterar a través de los años y meses en el rango definido
-    for year in range(start_year, end_year + 1):
-      
-      for month in range(1, 13):
-        if year == start_year and month < start_month:
-            continue  # Saltar meses anteriores al inicio
-        if year == end_year and month > end_month:
-            break  # Salir del bucle si se excede el final
-        # Iterar a través de los días del mes
-        num_days = calendar.monthrange(year, month)[1]
-        for day in range(1, num_days + 1):
-          try:
-            # Crear el prefijo de fecha para el raster
-            date_str = f"{year}{month:02d}{day:02d}"  # Formato YYYYMMDD
-
-            # Definir las rutas de los rasters dentro de las carpetas correspondientes
-            t_max_raster = os.path.join(self.output_path, "TMAX", f"TMAX_{date_str}.tif")
-            t_min_raster = os.path.join(self.output_path, "TMIN", f"TMIN_{date_str}.tif")
-            prec_raster = os.path.join(self.output_path, "PREC", f"PREC_{date_str}.tif")
-            sol_rad_raster = os.path.join(self.output_path, "SRAD", f"SRAD_{date_str}.tif")
-            # Extraer datos de los rasters
-            for raster_path in [t_max_raster, t_min_raster, prec_raster, sol_rad_raster]:
-              if os.path.exists(raster_path):  # Comprobar si el archivo existe
-                with rasterio.open(raster_path) as src:
-                  # Obtener la transformación y la matriz de datos
-                  transform = src.transform
-                  row, col = ~transform * (lon, lat)
-
-                  # Leer el valor en la posición (row, col)
-                  value = src.read(1, window=((row, row + 1), (col, col + 1)))
-                  value = value[0][0] if value.size > 0 else np.nan
-                  # Almacenar los datos en el diccionario
-                  if raster_path == t_max_raster:
-                      data['t_max'].append(value)
-                  elif raster_path == t_min_raster:
-                      data['t_min'].append(value)
-                  elif raster_path == prec_raster:
-                      data['prec'].append(value)
-                  elif raster_path == sol_rad_raster:
-                      data['sol_rad'].append(value)
-            # Agregar la fecha al conjunto de datos
-            data['day'].append(day)
-            data['month'].append(month)
-            data['year'].append(year)
-
-          except (FileNotFoundError, ValueError):
-              continue  # Saltar si el archivo no se encuentra o hay otro error
-
-    return data
+    date_strs = [date.replace("-", "") for date in dates]  # Formato YYYYMMDD
+
+    for variable, folder in self.variables.items():
+      if variables is not None and variable not in variables:
+        continue
+      data[variable] = np.full((len(dates), len(lons)), np.nan, dtype=np.float32)
+      pending = range(len(dates))
+
+      if self.cube is not None and self.cube.exists(folder):
+        # Los días que no están en el cubo (recortados antes de --cube o saltados) se leen de los rasters
+        in_cube = self.cube.dates(folder)
+        cube_days = [i for i in pending if date_strs[i] in in_cube]
+        pending = [i for i in pending if date_strs[i] not in in_cube]
+        if cube_days:
+          values, weights, inside = self.sample_cube(folder, [date_strs[i] for i in cube_days], lons, lats)
+          data[variable][cube_days] = self.apply_weights(values, weights)
+          outside[variable] = ~inside
+
+      # Días agrupados por grilla: pesos, índices de los días y valores de las celdas
+      grids = {}
+
+      for i in pending:
+        date_str = date_strs[i]
+        raster_path = os.path.join(self.output_path, folder, f"{folder}_{date_str}.tif")
+        if not os.path.exists(raster_path):  # Comprobar si el archivo existe
+          continue
+
+        day_values, weights, inside = self.sample_raster(raster_path, lons, lats)
+        if variable not in outside:
+          outside[variable] = ~inside
+        grid = grids.setdefault(id(weights), (weights, [], []))
+        grid[1].append(i)
+        grid[2].append(day_values)
+
+      for weights, days, values in grids.values():
+        data[variable][days] = self.apply_weights(np.stack(values), weights)
+
+    return data, outside
 
   def save_to_csv(self, id, data):
     # Crear un DataFrame y guardar como CSV
@@ -90,11 +216,123 @@ class DataExtractor:
     df.to_csv(output_csv, index=False)
     print(f"Saved data for ID {id} to {output_csv}")
 
+  def read_last_date(self, output_csv):
+    # Lee solo la última línea del CSV (day,month,year,...) y devuelve YYYYMMDD
+    with open(output_csv, "rb") as f:
+      f.seek(0, os.SEEK_END)
+      position = f.tell()
+      line = b""
+      while position > 0:
+        step = min(4096, position)
+        position -= step
+        f.seek(position)
+        line = f.read(step) + line
+        if line.strip().count(b"\n") > 0:
+          break
+      last = line.strip().split(b"\n")[-1].decode("utf-8").split(",")
+    try:
+      return int(last[2]) * 10000 + int(last[1]) * 100 + int(last[0])
+    except (IndexError, ValueError):
+      return None
+
+  def update_csv(self, id, data):
+    """
+    Agrega los días extraídos al CSV de la estación. Los días que ya estaban en
+    el archivo se reemplazan. El archivo se escribe en un temporal y se renombra.
+    """
+    output_csv = os.path.join(self.output_path, f"{id}_daily.csv")
+    if not os.path.exists(output_csv):
+      self.save_to_csv(id, data)
+      return
+
+    df = pd.DataFrame(data)
+    new_dates = df['year'] * 10000 + df['month'] * 100 + df['day']
+    last_date = self.read_last_date(output_csv)
+    tmp_csv = f"{output_csv}.tmp"
+
+    if last_date is not None and last_date < new_dates.min():
+      # Solo hay días nuevos, se agregan al final sin leer la historia
+      shutil.copyfile(output_csv, tmp_csv)
+      df.to_csv(tmp_csv, mode="a", header=False, index=False)
+    else:
+      old = pd.read_csv(output_csv)
+      old_dates = old['year'] * 10000 + old['month'] * 100 + old['day']
+      kept = old[~old_dates.isin(new_dates)]
+      merged = pd.concat([kept, df], ignore_index=True) if len(kept) > 0 else df
+      merged = merged.sort_values(['year', 'month', 'day'], kind="stable")
+      merged.to_csv(tmp_csv, index=False)
+
+    os.replace(tmp_csv, output_csv)
+    print(f"Updated data for ID {id} in {output_csv}")
+
+  def save_to_parquet(self, ids, data):
+    """
+    Escribe las series de todas las estaciones en un dataset Parquet particionado
+    por año y mes (year=YYYY/month=M). Dentro de cada archivo las filas están
+    ordenadas por id y fecha, así las lecturas filtradas por id y fecha solo
+    abren las particiones y row groups necesarios.
+
+    Every run writes whole months and replaces the month partitions it
+    touches, so overlapping runs never duplicate days.
+    """
+    dates = pd.to_datetime(pd.DataFrame({'year': data['year'], 'month': data['month'], 'day': data['day']}))
+    n_days, n_points = len(dates), len(ids)
+
+    # Orden por estación y luego por fecha
+    columns = {
+        'id': pa.array(np.repeat(np.asarray(ids), n_days)),
+        'date': pa.array(np.tile(dates.values.astype("datetime64[D]"), n_points), type=pa.date32()),
+    }
+    for variable in self.variables:
+      columns[variable] = pa.array(np.asarray(data[variable], dtype=np.float32).T.ravel(), type=pa.float32())
+    columns['year'] = pa.array(np.tile(dates.dt.year.values, n_points), type=pa.int16())
+    columns['month'] = pa.array(np.tile(dates.dt.month.values, n_points), type=pa.int8())
+    table = pa.table(columns)
+
+    partitioning = ds.partitioning(pa.schema([('year', pa.int16()), ('month', pa.int8())]), flavor="hive")
+    file_options = ds.ParquetFileFormat().make_write_options(compression="zstd")
+    ds.write_dataset(table, self.parquet_path, format="parquet", partitioning=partitioning,
+                     basename_template="part-{i}.parquet",
+                     existing_data_behavior="delete_matching", file_options=file_options,
+                     max_rows_per_group=1024 * 1024)
+    print(f"Saved data for {n_points} stations to {self.parquet_path}")
+
+  def extract(self, folders=None):
+    """
+    Extracts the series of the variables whose rasters are in folders (all by
+    default) and keeps them until process() writes the outputs.
+    """
+    coords_df = self.read_coordinates()
+    variables = [variable for variable, folder in self.variables.items() if folders is None or folder in folders]
+    data, outside = self.extract_raster_data(self.start_date, self.end_date, coords_df['long'].values, coords_df['lat'].values, variables)
+    with self.lock:
+      self.extracted.update(data)
+      self.outside.update(outside)
+
   def process(self):
     coords_df = self.read_coordinates()
-    for index, row in coords_df.iterrows():
-        id = row['id']
-        lat = row['lat']
-        lon = row['long']
-        data = self.extract_raster_data(self.start_date, self.end_date, lon, lat)
-        self.save_to_csv(id, data)
\ No newline at end of file
+    ids = coords_df['id'].tolist()
+
+    # Solo se extraen las variables que no se extrajeron antes
+    pending = [folder for variable, folder in self.variables.items() if variable not in self.extracted]
+    if pending:
+      self.extract(pending)
+    data, outside = self.extracted, self.outside
+
+    # Reportar los puntos que quedan fuera de los rasters
+    for variable, mask in outside.items():
+      if np.any(mask):
+        print(f"Points outside the {self.variables[variable]} rasters: {[id for id, out in zip(ids, mask) if out]}")
+
+    if self.output_format == "parquet":
+      self.save_to_parquet(ids, data)
+      return
+
+    for index, id in enumerate(ids):
+      station = {'day': data['day'], 'month': data['month'], 'year': data['year']}
+      for variable in self.variables:
+        station[variable] = data[variable][:, index]
+      if self.incremental:
+        self.update_csv(id, station)
+      else:
+        self.save_to_csv(id, station)
@@ -0,0 +1,130 @@
+import os
+import threading
+import numpy as np
+import netCDF4
+import rasterio
+from datetime import datetime, timedelta
+from affine import Affine
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
+
+
+class DataCube():
+  """
+  Per-country, per-variable NetCDF4 store of the clipped daily grids.
+
+  Every day is appended along an unlimited time dimension with time-major
+  chunks, so the daily series of a point is read from a handful of chunks
+  instead of one GeoTIFF per day. The GeoTIFFs are still written for GeoServer.
+  """
+
+  def __init__(self, cube_path, country, time_chunk=365, space_chunk=32):
+    self.cube_path = cube_path
+    self.country = country
+    self.time_chunk = time_chunk
+    self.space_chunk = space_chunk
+    self.lock = threading.Lock()
+
+    os.makedirs(self.cube_path, exist_ok=True)
+
+  def get_file(self, variable):
+    return os.path.join(self.cube_path, f"{self.country}_{variable}.nc")
+
+  def exists(self, variable):
+    return os.path.exists(self.get_file(variable))
+
+  def date_to_days(self, date_str):
+    return (datetime.strptime(date_str, "%Y%m%d") - datetime(1970, 1, 1)).days
+
+  def create(self, file, variable, height, width, transform, crs):
+    with netCDF4.Dataset(file, "w") as nc:
+      nc.createDimension("time", None)
+      nc.createDimension("lat", height)
+      nc.createDimension("lon", width)
+
+      time = nc.createVariable("time", "i4", ("time",))
+      time.units = "days since 1970-01-01"
+      time.calendar = "standard"
+
+      # Centros de las celdas a partir de la transformación del raster
+      lat = nc.createVariable("lat", "f8", ("lat",))
+      lat[:] = transform.f + transform.e * (np.arange(height) + 0.5)
+      lon = nc.createVariable("lon", "f8", ("lon",))
+      lon[:] = transform.c + transform.a * (np.arange(width) + 0.5)
+
+      data = nc.createVariable(variable, "f4", ("time", "lat", "lon"), zlib=True, fill_value=np.nan,
+                               chunksizes=(self.time_chunk, min(height, self.space_chunk), min(width, self.space_chunk)))
+      data.transform = list(transform)[:6]
+      data.crs = crs.to_wkt() if crs is not None else ""
+
+  def append(self, variable, date_str, image, transform, crs):
+    """
+    Adds the grid (rows, cols) of date_str (YYYYMMDD) to the cube of variable.
+    A day that is already in the cube is replaced.
+    """
+    file = self.get_file(variable)
+    height, width = image.shape[-2:]
+
+    with self.lock, NETCDF4_PYTHON_LOCK:
+      if not os.path.exists(file):
+        self.create(file, variable, height, width, transform, crs)
+
+      with netCDF4.Dataset(file, "a") as nc:
+        data = nc.variables[variable]
+        if data.shape[1:] != (height, width) or not Affine(*data.transform).almost_equals(transform):
+          raise ValueError(f"The grid of {date_str} does not match the cube {file}")
+
+        days = self.date_to_days(date_str)
+        times = nc.variables["time"][:]
+        index = np.flatnonzero(times == days)
+        index = int(index[0]) if len(index) > 0 else len(times)
+
+        nc.variables["time"][index] = days
+        data[index, :, :] = np.asarray(image, dtype=np.float32).reshape(height, width)
+
+  def append_raster(self, raster_file, image, transform, crs):
+    # Los rasters recortados se llaman VARIABLE_YYYYMMDD.tif
+    variable, date_str = os.path.splitext(os.path.basename(raster_file))[0].split("_")
+    self.append(variable, date_str, image, transform, crs)
+
+  def append_rasters(self, raster_files):
+    # Agrega rasters recortados ya escritos (por ejemplo por los shards), en el orden dado
+    for raster_file in raster_files:
+      with rasterio.open(raster_file) as src:
+        self.append_raster(raster_file, src.read(1), src.transform, src.crs)
+
+  def dates(self, variable):
+    # Días (YYYYMMDD) guardados en el cubo
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(self.get_file(variable), "r") as nc:
+      return set((datetime(1970, 1, 1) + timedelta(days=int(days))).strftime("%Y%m%d") for days in nc.variables["time"][:])
+
+  def grid(self, variable):
+    # Transformación y tamaño de la grilla del cubo
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(self.get_file(variable), "r") as nc:
+      data = nc.variables[variable]
+      _, height, width = data.shape
+      return Affine(*data.transform), height, width
+
+  def read_cells(self, variable, date_strs, rows, cols):
+    """
+    Reads the series of the grid cells (rows, cols) for the dates (YYYYMMDD).
+
+    Returns an array (dates, cells) with NaN where the day is not in the cube.
+    """
+    values = np.full((len(date_strs), len(rows)), np.nan, dtype=np.float32)
+
+    with NETCDF4_PYTHON_LOCK, netCDF4.Dataset(self.get_file(variable), "r") as nc:
+      data = nc.variables[variable]
+
+      # Posición de cada fecha pedida dentro del eje de tiempo del cubo
+      positions = {int(days): i for i, days in enumerate(nc.variables["time"][:])}
+      wanted = [positions.get(self.date_to_days(date_str)) for date_str in date_strs]
+      found = np.array([i for i, position in enumerate(wanted) if position is not None], dtype=int)
+      if len(found) == 0:
+        return values
+      time_index = np.array([wanted[i] for i in found])
+
+      for cell, (row, col) in enumerate(zip(rows, cols)):
+        series = data[:, row, col]
+        values[found, cell] = np.ma.filled(series, np.nan)[time_index]
+
+    return values
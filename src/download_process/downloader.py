@@ -0,0 +1,106 @@
+import os
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from tools import DownloadProgressBar, Response
+
+
+class Downloader():
+
+  def __init__(self, workers=4, retries=3, backoff=2, timeout=60, chunk_size=1024 * 1024):
+
+    self.workers = workers
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.chunk_size = chunk_size
+
+    # One keep-alive pool shared by every worker, sized to the concurrency
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  def is_retryable(self, error):
+    # Missing files (404) or forbidden requests will not be fixed by retrying
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+      return error.response.status_code >= 500 or error.response.status_code == 429
+    return True
+
+  def remote_size(self, url, response):
+    # Size of the file from the Content-Range of a 416 (bytes */N), or from a HEAD request
+    content_range = response.headers.get("Content-Range", "")
+    if content_range.startswith("bytes */") and content_range[8:].isdigit():
+      return int(content_range[8:])
+    head = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+    length = head.headers.get("Content-Length")
+    return int(length) if head.ok and length is not None and length.isdigit() else None
+
+  def fetch(self, url, part_path):
+    # Resume from the bytes already written in the .part file
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+
+    with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+      if r.status_code == 416:
+        # The range starts at the end of the file: the .part is complete only if it has its exact size
+        if self.remote_size(url, r) == offset:
+          return
+        print(f"\tThe partial download of {url} does not match the remote file, it is downloaded again")
+        r.close()
+        os.remove(part_path)
+        return self.fetch(url, part_path)
+      r.raise_for_status()
+
+      if offset > 0 and r.status_code != 206:
+        # The server ignored the range, start again
+        offset = 0
+
+      length = r.headers.get("Content-Length")
+      total = int(length) + offset if length is not None else None
+
+      with open(part_path, "ab" if offset > 0 else "wb") as f:
+        with DownloadProgressBar(unit='B', unit_scale=True, miniters=1, desc=url.split('/')[-1], total=total, initial=offset) as t:
+          for chunk in r.iter_content(chunk_size=self.chunk_size):
+            f.write(chunk)
+            t.update(len(chunk))
+
+    if total is not None and os.path.getsize(part_path) < total:
+      raise requests.exceptions.ChunkedEncodingError(f"Incomplete download: {url}")
+
+  def download(self, url, path):
+    """
+    Download url to path through a .part file that is resumed with HTTP Range
+    requests on every retry. Returns a Response with the path or the error.
+    """
+    part_path = f"{path}.part"
+
+    for attempt in range(self.retries + 1):
+      try:
+        self.fetch(url, part_path)
+        os.replace(part_path, path)
+        return Response(res=path)
+      except (requests.exceptions.RequestException, OSError) as error:
+        if attempt == self.retries or not self.is_retryable(error):
+          return Response(error=str(error))
+        wait = self.backoff ** attempt
+        print(f"\tRetrying {url} in {wait}s: {error}")
+        time.sleep(wait)
+
+  def run(self, function, *iterables):
+    # Bounded concurrency, every result is collected so no error is lost
+    with ThreadPoolExecutor(max_workers=self.workers) as executor:
+      return list(executor.map(function, *iterables))
+
+  def summary(self, urls, results):
+    failed = [(url, result.error) for url, result in zip(urls, results) if result.error is not None]
+
+    print(f"\tDownloaded {len(results) - len(failed)} of {len(results)} files")
+    for url, error in failed:
+      print(f"\tFailed: {url} -> {error}")
+
+    return failed
+
+  def close(self):
+    self.session.close()
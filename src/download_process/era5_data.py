@@ -1,25 +1,29 @@
 import os
-import urllib.request
-import gzip
 import geopandas as gpd
 import rasterio
 import numpy as np
 import xarray as xr
 import rioxarray 
-import cdsapi
 import calendar
+import math
+import re
+import netCDF4
+import shutil
+from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK
 from zipfile import ZipFile
-from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor
-from rasterio.mask import mask
-from shapely.geometry import mapping
-from tools import DownloadProgressBar, Tools
-from tqdm import tqdm
+from datetime import datetime
+from tools import Tools
+from clip_plan import ClipPlan
+from cds_scheduler import CdsScheduler, CdsJob
+from manifest import Manifest
+from datacube import DataCube
+from run_state import RunState, get_run_state_file
+from clip_pool import ClipPool, clip_raster_file, convert_netcdf, transform_values
 
 
 class Era5Data():
 
-  def __init__(self, output_path, country, start_date, end_date, download_data_path):
+  def __init__(self, output_path, country, start_date, end_date, download_data_path, fused=False, cds_requests=8, months_per_request=3, cds_client_factory=None, area=False, area_request=True, from_zip=False, cube=False, days=None, processes=1, shard=None):
      
     self.output_path = output_path
     self.download_data_path = download_data_path
@@ -27,8 +31,25 @@ class Era5Data():
     self.start_date = start_date
     self.end_date = end_date
 
+    # days: only these days (YYYY-MM-DD) of the range are processed, all of them by default
+    self.days = set(day.replace("-", "") for day in days) if days is not None else None
+
+    # fused: convert the NetCDFs straight to clipped rasters, without global rasters
+    self.fused = fused
+
+    # Requests queued at once in the CDS and months merged in each request
+    self.months_per_request = months_per_request
+    self.scheduler = CdsScheduler(client_factory=cds_client_factory, max_requests=cds_requests)
+
+    # area: keep only the country bounding box of the ERA5 data
+    # area_request: ask the CDS for that box, otherwise it is cut after the download
+    self.area = area
+    self.area_request = area_request
+
+    # from_zip: convert the NetCDFs read from the downloaded zips, without extracting them
+    self.from_zip = from_zip
+
     self.tools = Tools()
-    self.cores = 4
 
     self.project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
     self.shapefile_path = os.path.join(self.project_root,"shapefiles")
@@ -40,6 +61,9 @@ class Era5Data():
     self.downloaded_data_path = os.path.join(self.download_data_path,"downloadedData")
 
     self.era5_path = os.path.join(self.downloaded_data_path,"ERA5")
+    if self.area:
+      # Los NetCDFs solo cubren el país, no se comparten con otros países
+      self.era5_path = os.path.join(self.era5_path, self.country)
     self.era5_rasters_path = os.path.join(self.era5_path,"rasters")
 
     self.tmax_path = os.path.join(self.era5_path,"TMAX")
@@ -67,8 +91,30 @@ class Era5Data():
     self.tools.create_dir(self.tmin_output_path)
     self.tools.create_dir(self.srad_output_path)
 
+    # Index of the files of the data directories, listed once per run
+    self.manifest = Manifest(os.path.join(self.era5_path, "manifest.json"))
+
+    # Optional per-variable datacube next to the GeoTIFFs
+    self.cube = DataCube(os.path.join(self.output_path, "cube"), self.country) if cube else None
+
+    # Window and mask of the country, computed once for the ERA5 grid
+    self.clip_plan = ClipPlan(self.country_path, os.path.join(self.downloaded_data_path, "clip_plans"))
+    self.country_bounds = None
+
+    # Processes used to convert and clip the rasters, one runs them in this process
+    self.pool = ClipPool(self.clip_plan, processes)
+
+    # Estado de cada día (descarga, conversión, recorte), compartido con las otras etapas
+    # Con shard (i, N) cada nodo usa su propia base, no se comparte SQLite entre nodos
+    self.run_state = RunState(get_run_state_file(self.output_path, shard))
+    # Solicitudes al CDS que fallaron en esta corrida
+    self.failed_jobs = []
+
     self.ERA5_FILE = "_C3S-glob-agric_AgERA5_"
     self.ERA5_FILE_TYPE = "_final-v1.1.nc"
+    # AgERA5 grid resolution and cells added around the country bounding box
+    self.ERA5_RESOLUTION = 0.1
+    self.AREA_BUFFER = 2
     self.cdsapi_version = "1_1"
     self.enum_variables ={
                         "t_max":{"name":"2m_temperature",
@@ -87,8 +133,11 @@ class Era5Data():
 
     pass
 
-  def generate_days(self):
-    return [f"{day:02}" for day in range(1, 32)]
+  def generate_days(self, year=None, month=None):
+    # Sin año y mes se devuelven los 31 días posibles (solicitud al CDS)
+    if year is None or month is None:
+      return [f"{day:02}" for day in range(1, 32)]
+    return [f"{day:02}" for day in range(1, calendar.monthrange(int(year), int(month))[1] + 1)]
 
   # Función para generar el rango de meses con formato 'MM'
   def generate_month_range(self, year, start_year, start_month, end_year, end_month):
@@ -105,6 +154,10 @@ class Era5Data():
         # Recorrer todos los meses del año
         return [f"{month:02}" for month in range(1, 13)]
 
+  def in_days(self, date_str):
+    # date_str en formato YYYYMMDD
+    return self.days is None or date_str in self.days
+
   def get_variable(self, variable):
     if variable == "t_max":
       return "TMAX"
@@ -121,6 +174,73 @@ class Era5Data():
     elif variable == "sol_rad":
       return "Solar-Radiation-Flux"
 
+  def get_day(self, file):
+    # Fecha YYYYMMDD del nombre de un NetCDF de AgERA5 o de un raster VARIABLE_YYYYMMDD.tif
+    match = re.search(r"(?:AgERA5_|_)(\d{8})[_.]", os.path.basename(file))
+    return match.group(1) if match else None
+
+  def fail_days(self, variable, days, error):
+    # Registra el error en cada día (YYYYMMDD) afectado, --status los muestra
+    for day in days:
+      self.run_state.fail("ERA5", variable, day, error)
+
+  def extract_zip(self, file, variable_path):
+    with ZipFile(file, 'r') as zObject:
+      # Cada miembro se extrae a un temporal y se renombra, un NetCDF
+      # a medio extraer nunca tiene el nombre final
+      members = [member for member in zObject.namelist() if member.endswith(".nc")]
+      for member in members:
+        with zObject.open(member) as f_in, self.tools.atomic_path(os.path.join(variable_path, member)) as tmp_path:
+          with open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        self.manifest.add(os.path.join(variable_path, member))
+      print("\tExtracted!")
+
+    if self.area:
+      # El CDS no siempre recorta el área, se recorta antes de cualquier otro paso
+      for member in members:
+        self.subset_netcdf(os.path.join(variable_path, member))
+
+    variable_name = os.path.basename(os.path.normpath(variable_path))
+    self.run_state.set_many("ERA5", variable_name, [self.get_day(member) for member in members], "downloaded")
+
+    os.remove(file)
+    print("\tZIP file removed:", file)
+
+  def process_zip(self, file, variable):
+    """
+    Convierte a rasters recortados los NetCDFs del zip que están en el rango de
+    fechas y aún no tienen salida, leyéndolos directamente del zip.
+    """
+    output_rasters_path = os.path.join(self.output_path, self.get_variable(variable))
+    self.tools.create_dir(output_rasters_path)
+    dates = set(date.replace("-", "") for date in self.tools.generate_dates(self.start_date, self.end_date))
+    dates = set(date for date in dates if self.in_days(date))
+
+    with ZipFile(file, 'r') as zObject:
+      # Agrupar los miembros necesarios por mes
+      months = {}
+      for member in sorted(zObject.namelist()):
+        match = re.search(r"AgERA5_(\d{8})_", member)
+        if not member.endswith(".nc") or match is None or match.group(1) not in dates:
+          continue
+
+        output_file = os.path.join(output_rasters_path, f"{self.get_variable(variable)}_{match.group(1)}.tif")
+        if self.manifest.exists(output_file):
+          continue
+
+        members, output_files = months.setdefault(match.group(1)[:6], ([], []))
+        members.append(member)
+        output_files.append(output_file)
+        self.run_state.set("ERA5", self.get_variable(variable), match.group(1), "downloaded")
+
+      for month, (members, output_files) in months.items():
+        print(f"\tConverting {month} ({len(members)} days) from {os.path.basename(file)}")
+        self.clip_netcdf_month(variable, members, output_files, zObject)
+
+    os.remove(file)
+    print("\tZIP file removed:", file)
+
   def download_era5_data(self, variables=["t_max","t_min","sol_rad"]):
     
     # Define the variables classes and their parameters for the CDSAPI
@@ -128,6 +248,10 @@ class Era5Data():
     start_year, start_month = map(int, self.start_date.split('-'))
     end_year, end_month = map(int, self.end_date.split('-'))
 
+    jobs = []
+
+    area = {'area': self.get_country_area()} if self.area and self.area_request else {}
+
     # Process for each variable that should be downloaded
     for v in variables:
       print("\tProcesing",v)
@@ -139,37 +263,45 @@ class Era5Data():
       for year in range(start_year, end_year + 1):
         # Definir los meses a recorrer según si es el año inicial, intermedio o final
         months = self.generate_month_range(year, start_year, start_month, end_year, end_month)
-
-        for month in months: 
-          if not self.check_files_exist(self.get_file_name(v), f"{year}-{month:02}", f"{year}-{month:02}", variable_path, "download"):
-
-            file = os.path.join(variable_path, f"{year}_{month}_{v}.zip")
-
-            c = cdsapi.Client(timeout=600)
-            c.retrieve('sis-agrometeorological-indicators',
-                {
-                    'format': 'zip',
-                    'variable': self.enum_variables[v]["name"],
-                    'statistic': self.enum_variables[v]["statistics"],
-                    'year': year,
-                    'month': [f"{month:02}"],
-                    'day': days_array,
-                    'version': self.cdsapi_version,
-                },
-                file
-            )
-            
-            with ZipFile(file, 'r') as zObject:
-              # Extracting all the members of the zip
-              # into a specific location.
-              zObject.extractall(path=variable_path)
-              print("\tExtracted!")
-            
-            os.remove(file)
-            print("\tZIP file removed:", file)
-
-      else:
-        print("\tFile already downloaded!")
+        if self.days is not None:
+          months = [month for month in months if any(day.startswith(f"{year}{month}") for day in self.days)]
+        if self.from_zip:
+          # Los NetCDFs no se extraen, se verifica la salida recortada
+          output_rasters_path = os.path.join(self.output_path, self.get_variable(v))
+          months = [month for month in months if not self.check_files_exist(self.get_variable(v), f"{year}-{month:02}", f"{year}-{month:02}", output_rasters_path, "rasters")]
+        else:
+          months = [month for month in months if not self.check_files_exist(self.get_file_name(v), f"{year}-{month:02}", f"{year}-{month:02}", variable_path, "download")]
+
+        # Varios meses del mismo año se piden en una sola solicitud
+        for i in range(0, len(months), self.months_per_request):
+          batch = months[i:i + self.months_per_request]
+          file = os.path.join(variable_path, f"{year}_{'-'.join(batch)}_{v}.zip")
+          request_days = days_array if self.days is None else sorted(set(day[6:] for day in self.days if day[:6] in [f"{year}{month}" for month in batch]))
+          job_days = [f"{year}{month}{day}" for month in batch for day in self.generate_days(year, month) if day in request_days]
+
+          jobs.append(CdsJob('sis-agrometeorological-indicators',
+              {
+                  'format': 'zip',
+                  'variable': self.enum_variables[v]["name"],
+                  'statistic': self.enum_variables[v]["statistics"],
+                  'year': year,
+                  'month': [f"{month:02}" for month in batch],
+                  'day': request_days,
+                  'version': self.cdsapi_version,
+                  **area,
+              },
+              file,
+              on_complete=lambda target, path=variable_path, v=v: self.process_zip(target, v) if self.from_zip else self.extract_zip(target, path),
+              on_error=lambda error, v=v, days=job_days: self.fail_days(self.get_variable(v), days, error)
+          ))
+
+    if len(jobs) == 0:
+      print("\tFile already downloaded!")
+      return
+
+    # All the requests are queued in the CDS at once
+    self.scheduler.run(jobs)
+    self.failed_jobs = [job for job in jobs if job.state != "downloaded"]
 
   def file_format(self, variable, date_str, type):
      if type == "download":
@@ -222,9 +354,9 @@ class Era5Data():
             file_path = os.path.join(directory, expected_filename)
             file_path_2 = os.path.join(directory, f"{variable}{self.ERA5_FILE}{date_str}_final-v1.1.1.nc")
             
-            # Verificar si el archivo existe
-            if not os.path.isfile(file_path):
-              if (type == "download" and not os.path.isfile(file_path_2)): 
+            # Verificar si el archivo existe, sin consultar el disco
+            if not self.manifest.exists(file_path):
+              if (type == "download" and not self.manifest.exists(file_path_2)): 
                 print(f"Missing file: {expected_filename}")
                 return False  # Falta algún archivo
               elif type == "rasters":
@@ -247,7 +379,6 @@ class Era5Data():
     """
 
     variables=["t_max","t_min","sol_rad"]
-    new_crs = '+proj=longlat +datum=WGS84 +no_defs'
 
     # Generar rango de fechas
     start_year, start_month = map(int, self.start_date.split('-'))
@@ -265,24 +396,28 @@ class Era5Data():
       variable_path = os.path.join(self.era5_path, self.get_variable(variable))
 
       if not self.check_files_exist(self.get_variable(variable), self.start_date, self.end_date, raster_save_path, "rasters"):
-      
+
+        tasks = []
         for year in range(start_year, end_year + 1):
           months = self.generate_month_range(year, start_year, start_month, end_year, end_month)
 
           # Recorrer los meses
           for month in months:
-              days_array = self.generate_days()
+              days_array = self.generate_days(year, month)
 
               # Recorrer cada día del mes
               for day in days_array:
+                if not self.in_days(f"{year}{month}{day}"):
+                  continue
+
                 # Construir el nombre del archivo NetCDF a partir del año, mes y día
                 nc_file_name = f"{self.get_file_name(variable)}{self.ERA5_FILE}{year}{month}{day}{self.ERA5_FILE_TYPE}"
                 input_file = os.path.join(variable_path, nc_file_name)
                 input_file_2 = os.path.join(variable_path, f"{self.get_file_name(variable)}{self.ERA5_FILE}{year}{month}{day}_final-v1.1.1.nc")
 
-                if os.path.exists(input_file) or os.path.exists(input_file_2):
+                if self.manifest.exists(input_file) or self.manifest.exists(input_file_2):
 
-                  if not os.path.exists(input_file):
+                  if not self.manifest.exists(input_file):
                      input_file = input_file_2
 
                   print(f"\tConverting {input_file} to raster...")
@@ -290,31 +425,197 @@ class Era5Data():
                   # Definir el archivo de salida .tif
                   output_file = os.path.join(raster_save_path, f"{self.get_variable(variable)}_{year}{month}{day}.tif")
 
-                  # Leer y procesar el archivo NetCDF
-                  xds = xr.open_dataset(input_file)
-                  
-                  # Transformación basada en la variable (según tu lógica)
-                  if self.enum_variables[variable]["transform"] == "-":
-                      xds = xds - self.enum_variables[variable]["value"]
-                  elif self.enum_variables[variable]["transform"] == "/":
-                      xds = xds / self.enum_variables[variable]["value"]
+                  # Los días ya convertidos en una corrida anterior no se repiten
+                  if self.manifest.exists(output_file) and self.run_state.reached("ERA5", self.get_variable(variable), f"{year}{month}{day}", "converted"):
+                    continue
 
-                  # Aplicar CRS y guardar como raster
-                  xds.rio.write_crs(new_crs, inplace=True)
-                  variable_names = list(xds.variables)
-
-                  # Guardar en formato .tif
-                  xds[variable_names[3]].rio.to_raster(output_file)
-                  print(f"\tSaved raster to {output_file}")
+                  # Transformación de unidades y CRS según la variable
+                  tasks.append((input_file, output_file, self.enum_variables[variable]["transform"], self.enum_variables[variable]["value"]))
 
                 else:
                   print(f"\tFile not found: {input_file}")
 
+        # Las conversiones se reparten entre los procesos, los resultados llegan en orden,
+        # si una falla es la siguiente tarea sin resultado
+        done = 0
+        try:
+          for output_file, _ in self.pool.map(convert_netcdf, tasks):
+            self.manifest.add(output_file)
+            self.run_state.set("ERA5", self.get_variable(variable), self.get_day(output_file), "converted")
+            print(f"\tSaved raster to {output_file}")
+            done += 1
+        except Exception as error:
+          self.fail_days(self.get_variable(variable), [self.get_day(task[1]) for task in tasks[done:done + 1]], error)
+          raise
+
         print("\nConversion complete: ", variable)
 
       else:
          print(f"\nThe rasters of the variable {variable} are already found") 
 
+  def apply_transform(self, variable, xds):
+    return transform_values(xds, self.enum_variables[variable]["transform"], self.enum_variables[variable]["value"])
+
+  def get_netcdf_file(self, variable, variable_path, date_str):
+    # AgERA5 publishes the files as v1.1 or v1.1.1
+    for file_type in [self.ERA5_FILE_TYPE, "_final-v1.1.1.nc"]:
+      input_file = os.path.join(variable_path, f"{self.get_file_name(variable)}{self.ERA5_FILE}{date_str}{file_type}")
+      if self.manifest.exists(input_file):
+        return input_file
+    return None
+
+  def get_country_bounds(self):
+    # Bounding box of the country in lon/lat (minx, miny, maxx, maxy)
+    if self.country_bounds is None:
+      shapefile = gpd.read_file(self.country_path).to_crs("EPSG:4326")
+      self.country_bounds = tuple(shapefile.total_bounds)
+    return self.country_bounds
+
+  def get_country_area(self):
+    """
+    Bounding box of the country snapped outwards to the AgERA5 grid plus
+    AREA_BUFFER cells, in the CDS order [north, west, south, east].
+    """
+    minx, miny, maxx, maxy = self.get_country_bounds()
+    res = self.ERA5_RESOLUTION
+    buffer = self.AREA_BUFFER * res
+
+    north = min(90, math.ceil(maxy / res) * res + buffer)
+    west = max(-180, math.floor(minx / res) * res - buffer)
+    south = max(-90, math.floor(miny / res) * res - buffer)
+    east = min(180, math.ceil(maxx / res) * res + buffer)
+    return [round(value, 6) for value in (north, west, south, east)]
+
+  def subset_to_country(self, xds):
+    """
+    Select the cells of the country area so the transform and the clip only
+    touch the country instead of the global grid.
+    """
+    north, west, south, east = self.get_country_area()
+    x_dim, y_dim = xds.rio.x_dim, xds.rio.y_dim
+    x_slice = slice(west, east)
+    # Las latitudes pueden estar en orden descendente
+    if xds[y_dim].values[0] > xds[y_dim].values[-1]:
+      y_slice = slice(north, south)
+    else:
+      y_slice = slice(south, north)
+    return xds.sel({x_dim: x_slice, y_dim: y_slice})
+
+  def subset_netcdf(self, nc_file):
+    # Reescribe el NetCDF solo con el área del país
+    with xr.open_dataset(nc_file) as xds:
+      subset = self.subset_to_country(xds).load()
+
+    tmp_file = f"{nc_file}.tmp"
+    subset.to_netcdf(tmp_file)
+    os.replace(tmp_file, nc_file)
+
+  def open_netcdf(self, input_file, zip_file=None):
+    if zip_file is None:
+      return xr.open_dataset(input_file)
+
+    # Leer el miembro del zip en memoria, nunca se escribe en disco
+    # netCDF4/HDF5 no es seguro entre hilos, se usa el mismo lock de xarray
+    with NETCDF4_PYTHON_LOCK:
+      nc = netCDF4.Dataset(input_file, memory=zip_file.read(input_file))
+    return xr.open_dataset(xr.backends.NetCDF4DataStore(nc))
+
+  def read_netcdf(self, input_file, zip_file=None):
+    new_crs = '+proj=longlat +datum=WGS84 +no_defs'
+
+    # El archivo se cierra apenas se lee la ventana del país
+    with self.open_netcdf(input_file, zip_file) as xds:
+      variable_names = list(xds.variables)
+      data = xds[variable_names[3]]
+      data.rio.write_crs(new_crs, inplace=True)
+
+      # Recortar al bounding box del país antes de cualquier operación
+      return self.subset_to_country(data).load()
+
+  def clip_netcdf_month(self, variable, input_files, output_files, zip_file=None):
+    """
+    Convierte los NetCDFs diarios de un mes en rasters recortados al país.
+    Los días se apilan en el tiempo y la transformación y la máscara se aplican
+    una sola vez sobre todo el mes. Con zip_file, input_files son miembros del zip.
+    """
+    data = xr.concat([self.read_netcdf(input_file, zip_file) for input_file in input_files], dim="time")
+    # Los rasters se escriben con el tipo del NetCDF de origen
+    source_dtype = data.dtype
+    data = self.apply_transform(variable, data)
+
+    out_image = data.values.reshape((-1,) + data.shape[-2:]).astype(source_dtype, copy=False)
+    nodata = data.rio.encoded_nodata
+    out_image, out_transform = self.clip_plan.clip_array(out_image, data.rio.transform(), data.rio.crs, nodata)
+
+    if nodata is not None:
+      out_image[out_image == nodata] = np.nan
+
+    out_meta = {
+        "driver": "GTiff",
+        "dtype": source_dtype,
+        "count": 1,
+        "height": out_image.shape[1],
+        "width": out_image.shape[2],
+        "crs": data.rio.crs,
+        "transform": out_transform,
+        "nodata": nodata
+    }
+
+    for day_image, output_file in zip(out_image, output_files):
+      with self.tools.atomic_path(output_file) as tmp_file:
+        with rasterio.open(tmp_file, "w", **out_meta) as dest:
+          dest.write(day_image, 1)
+      self.manifest.add(output_file)
+      self.run_state.set("ERA5", self.get_variable(variable), self.get_day(output_file), "clipped")
+      if self.cube is not None:
+        self.cube.append_raster(output_file, day_image, out_transform, data.rio.crs)
+      print(f"\tSaved cut raster to {output_file}")
+
+  def netcdf_to_clipped_raster(self, save_path):
+    """
+    Convierte los NetCDFs directamente a rasters recortados al país, sin escribir
+    los rasters globales intermedios. Se procesa un mes a la vez, así la memoria
+    no depende del largo del rango de fechas.
+
+    :param save_path: Ruta base donde se guardarán los archivos recortados.
+    """
+    variables = ["t_max", "t_min", "sol_rad"]
+    dates = self.tools.generate_dates(self.start_date, self.end_date)
+
+    for variable in variables:
+      print(f"\nProcessing variable: {variable}")
+
+      variable_path = os.path.join(self.era5_path, self.get_variable(variable))
+      output_rasters_path = os.path.join(save_path, self.get_variable(variable))
+      self.tools.create_dir(output_rasters_path)
+
+      # Agrupar los días pendientes por mes
+      months = {}
+      for date in dates:
+        date_str = date.replace("-", "")
+        output_file = os.path.join(output_rasters_path, f"{self.get_variable(variable)}_{date_str}.tif")
+        if not self.in_days(date_str) or self.manifest.exists(output_file):
+          continue
+
+        input_file = self.get_netcdf_file(variable, variable_path, date_str)
+        if input_file is None:
+          print(f"\tFile not found: {self.get_file_name(variable)}{self.ERA5_FILE}{date_str}")
+          continue
+
+        input_files, output_files = months.setdefault(date[:7], ([], []))
+        input_files.append(input_file)
+        output_files.append(output_file)
+
+      for month, (input_files, output_files) in months.items():
+        print(f"\tConverting {month} ({len(input_files)} days)")
+        try:
+          self.clip_netcdf_month(variable, input_files, output_files)
+        except Exception as error:
+          self.fail_days(self.get_variable(variable), [self.get_day(output_file) for output_file in output_files], error)
+          raise
+
+      print("\nConversion complete: ", variable)
+
   def cut_rasters(self, save_path):
       """
       Recorta los rasters de t_max, t_min y sol_rad utilizando un shapefile de país,
@@ -325,11 +626,6 @@ class Era5Data():
       :param start_date: Fecha de inicio en formato 'YYYY-MM' (ej: '2024-01').
       :param end_date: Fecha de fin en formato 'YYYY-MM' (ej: '2024-03').
       """
-      # Abrir el shapefile de país
-      shapefile = gpd.read_file(self.country_path)
-      # Convertir el shapefile a una lista de geometrías
-      shapes = [mapping(geom) for geom in shapefile.geometry]
-
       # Variables para procesar
       variables = ["t_max", "t_min", "sol_rad"]
 
@@ -356,6 +652,7 @@ class Era5Data():
           self.tools.create_dir(output_rasters_path)
 
           # Recorrer el rango de fechas mes a mes
+          tasks = []
           current_date = start_date_obj
           while current_date <= end_date_obj:
               year = current_date.year
@@ -365,52 +662,24 @@ class Era5Data():
               # Recorrer los días del mes
               for day in range(1, num_days_in_month + 1):
                   date_str = f"{year}{month:02d}{day:02d}"  # Formato YYYYMMDD
+                  if not self.in_days(date_str):
+                      continue
 
                   # Buscar archivos .tif correspondientes a esta fecha
                   raster_file = f"{self.get_variable(variable)}_{date_str}.tif"
                   raster_path = os.path.join(raster_save_path, raster_file)
 
+                  # Los días ya recortados en una corrida anterior no se repiten
+                  if self.manifest.exists(os.path.join(output_rasters_path, raster_file)) and self.run_state.reached("ERA5", self.get_variable(variable), date_str, "clipped"):
+                      continue
+
                   # Verificar si el archivo existe
-                  if os.path.isfile(raster_path):
+                  if self.manifest.exists(raster_path):
                       print(f"Processing file: {raster_file}")
 
-                      # Abrir el raster
-                      with rasterio.open(raster_path) as src:
-
-                          # Verificar si el CRS del shapefile es diferente al del raster y reproyectar si es necesario
-                          if shapefile.crs != src.crs:
-                              shapefile = shapefile.to_crs(src.crs)
-
-                          # Recortar el raster con el shapefile
-                          out_image, out_transform = mask(src, shapes, crop=True)
-                          if src.nodata is not None:
-                              nodata = src.nodata
-                              out_image[out_image == nodata] = np.nan
-
-                          # Manejo de valores no válidos
-                          invalid_value = -9999
-                          invalid_mask = (out_image == invalid_value)
-                          if np.any(invalid_mask):
-                              print("Hay valores -9999 en los datos recortados. Reemplazando con np.nan.")
-                              out_image[invalid_mask] = np.nan
-
-                          # Copiar metadatos del raster original y actualizar con el nuevo tamaño y transformación
-                          out_meta = src.meta.copy()
-                          out_meta.update({
-                              "driver": "GTiff",
-                              "height": out_image.shape[1],
-                              "width": out_image.shape[2],
-                              "transform": out_transform
-                          })
-
-                          # Definir el archivo de salida recortado en la carpeta de salida
-                          raster_cut_path = os.path.join(output_rasters_path, f"{raster_file}")
-
-                          # Guardar el raster recortado
-                          with rasterio.open(raster_cut_path, "w", **out_meta) as dest:
-                              dest.write(out_image)
-
-                          print(f"\tSaved cut raster to {raster_cut_path}")
+                      # Recortar el raster con el shapefile, la ventana y la mascara se calculan una sola vez por grilla
+                      raster_cut_path = os.path.join(output_rasters_path, f"{raster_file}")
+                      tasks.append((raster_path, raster_cut_path, self.cube is not None))
                   else:
                       print(f"File not found: {raster_file}")
 
@@ -420,10 +689,45 @@ class Era5Data():
               else:
                   current_date = datetime(year, month + 1, 1)
 
+          # Los recortes se reparten entre los procesos, los resultados llegan en orden,
+          # si uno falla es la siguiente tarea sin resultado
+          done = 0
+          try:
+              for raster_cut_path, image in self.pool.map(clip_raster_file, tasks):
+                  self.manifest.add(raster_cut_path)
+                  self.run_state.set("ERA5", self.get_variable(variable), self.get_day(raster_cut_path), "clipped")
+                  if self.cube is not None:
+                      self.cube.append_raster(raster_cut_path, *image)
+
+                  print(f"\tSaved cut raster to {raster_cut_path}")
+                  done += 1
+          except Exception as error:
+              self.fail_days(self.get_variable(variable), [self.get_day(task[1]) for task in tasks[done:done + 1]], error)
+              raise
+
       print("\nAll rasters cut and saved in the output directories!")
 
   def main(self):
+
+    try:
+      self.run()
+    finally:
+      self.pool.close()
+      self.manifest.save()
+      self.run_state.close()
+
+    # Los días de las solicitudes fallidas quedan con su error en el estado de la corrida
+    if self.failed_jobs:
+      raise RuntimeError(f"{len(self.failed_jobs)} ERA5 requests failed: " + ", ".join(os.path.basename(job.target) for job in self.failed_jobs))
+
+  def run(self):
       
     self.download_era5_data()
+    if self.from_zip:
+      # Los rasters recortados se escriben a medida que llega cada zip
+      return
+    if self.fused:
+      self.netcdf_to_clipped_raster(self.output_path)
+      return
     self.netcdf_to_raster(self.era5_rasters_path)
     self.cut_rasters(self.output_path)
@@ -1,65 +1,117 @@
 import os
-import sys
-from glob import glob
+import time
+from concurrent.futures import ThreadPoolExecutor
 from geoserver_conexion.tool import GeoserverClient
 
 
 class GeoserverImport():
 
-    def __init__(self, workspace, user, passw, geo_url):
+    def __init__(self, workspace, user, passw, geo_url, max_batch_bytes=256 * 1024 * 1024, max_uploads=2, retries=3, backoff=2,
+                 mode="upload", mosaic_path=None, server_path=None, client=None, zip_path=None):
         self.geo_url = f"{geo_url}rest/"
         self.user = user
         self.pwd = passw
         self.workspace = workspace
         self.folder_root = os.path.dirname(os.path.realpath(__file__))
         self.folder_properties = os.path.join(self.folder_root, "properties")
-        self.folder_layers = os.path.join(self.folder_root, "layers")
-        os.makedirs(self.folder_layers, exist_ok=True)
-        self.zip_path = os.path.join(self.folder_root, "zip")
+        # Cada corrida puede pasar su propia carpeta de zips
+        self.zip_path = zip_path if zip_path else os.path.join(self.folder_root, "zip")
         os.makedirs(self.zip_path, exist_ok=True)
-        self.folder_tmp = os.path.join(self.folder_root, "tmp")
-        os.makedirs(self.folder_tmp, exist_ok=True)
-
-
-    def connect_geoserver(self):
-
-        stores_aclimate = [x.split(os.sep)[-1] for x in glob(os.path.join(self.folder_layers,"*"), recursive = True)]
+        # Tamaño máximo de cada zip, cargas simultáneas (una por store) y reintentos por lote
+        self.max_batch_bytes = max_batch_bytes
+        self.max_uploads = max_uploads
+        self.retries = retries
+        self.backoff = backoff
+        # upload: zips sent through the REST API, external: Geoserver reads the rasters
+        # from mosaic_path, which it sees as server_path
+        self.mode = mode
+        self.mosaic_path = mosaic_path
+        self.server_path = server_path if server_path else mosaic_path
+        # Cliente compartido durante toda la corrida, se crea al conectar si no se pasa uno
+        self.client = client
+
+
+    def upload_store(self, geoclient, store_name, files):
+        """
+        Publishes the rasters of one store in batches of at most max_batch_bytes.
+        A failed batch is retried up to retries times and the next batches are
+        still uploaded. Returns the list of rasters that landed in the store.
+        """
+        landed = []
+        batches = geoclient.make_batches(files, self.max_batch_bytes)
+        print(f"Working with {store_name}: {len(files)} rasters in {len(batches)} batches")
+
+        for i, batch in enumerate(batches):
+            zip_name = f"{store_name}_{i}.zip"
+            for attempt in range(self.retries + 1):
+                store = None
+                try:
+                    store = geoclient.get_store(store_name)
+                    if self.mode == "external" and not store:
+                        print("Creating external mosaic", store_name)
+                        geoclient.create_external_mosaic(store_name, batch, self.folder_properties, self.mosaic_path, self.server_path)
+                    elif self.mode == "external":
+                        print("Harvesting mosaic", store_name)
+                        geoclient.harvest_external(store, batch, self.mosaic_path, self.server_path)
+                    elif not store:
+                        print("Creating mosaic", store_name)
+                        geoclient.create_mosaic(store_name, batch, self.folder_properties, self.zip_path, zip_name)
+                    else:
+                        print("Updating mosaic", store_name)
+                        geoclient.update_mosaic(store, batch, self.folder_properties, self.zip_path, zip_name)
+                    landed.extend(batch)
+                    break
+                except Exception as e:
+                    print(f"Batch {i + 1}/{len(batches)} of {store_name} failed (attempt {attempt + 1}): {e}")
+                    if not store and geoclient.get_store(store_name):
+                        # The mosaic was created with this batch, only its configuration failed
+                        landed.extend(batch)
+                        break
+                    if attempt < self.retries:
+                        time.sleep(self.backoff ** attempt)
+
+        return landed
+
+    def connect_geoserver(self, layers):
+        """
+        layers maps each store name to the list of rasters to publish in it.
+        The rasters are zipped from where they are, without staging copies.
+        The stores are uploaded concurrently, at most max_uploads at a time.
+
+        Returns a dict with the rasters that landed in each store, or None if
+        the connection failed.
+        """
+        stores_aclimate = list(layers)
 
 
         try:
 
-            print("Connecting")
-            geoclient = GeoserverClient(self.geo_url, self.user, self.pwd)
-            geoclient.connect()
-            geoclient.get_workspace(self.workspace)
-            print("Connected")
-
-            for current_store in stores_aclimate:
-                print("Working with",current_store)
-
-                current_layer = os.path.join(self.folder_layers, current_store)
-
-                store_name = current_store
-                store = geoclient.get_store(store_name)
-
-                if not store:
-                    print("Creating mosaic")
-                    geoclient.create_mosaic(store_name, current_layer, self.folder_properties, self.folder_tmp, self.zip_path)
-                else:
-                    print("Updating mosaic")
-                    geoclient.update_mosaic(store, current_layer, self.folder_properties, self.folder_tmp, self.zip_path)
-
-            return True    
+            geoclient = self.get_client()
         except Exception as e:
             print(str(e))
-            return False
+            return None
+
+        with ThreadPoolExecutor(max_workers=self.max_uploads) as executor:
+            futures = {store_name: executor.submit(self.upload_store, geoclient, store_name, layers[store_name])
+                       for store_name in stores_aclimate}
+            landed = {store_name: future.result() for store_name, future in futures.items()}
+
+        for store_name in stores_aclimate:
+            print(f"{store_name}: {len(landed[store_name])} of {len(layers[store_name])} rasters published")
+        return landed
 
     
-    def get_geoserver_stores(self):
+    def get_client(self):
+        if self.client is None:
+            self.client = GeoserverClient(self.geo_url, self.user, self.pwd, pool_size=self.max_uploads + 1)
         print("Connecting")
-        geoclient = GeoserverClient(self.geo_url, self.user, self.pwd)
-        geoclient.connect()
-        geoclient.get_workspace(self.workspace)
+        self.client.connect()
+        self.client.get_workspace(self.workspace)
+        print("Connected")
+        return self.client
+
+    def get_geoserver_stores(self):
+        geoclient = self.get_client()
 
         stores = geoclient.get_stores()
-        return stores
\ No newline at end of file
+        return stores
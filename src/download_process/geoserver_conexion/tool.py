@@ -1,13 +1,45 @@
 import os
 import sys
+import threading
+from contextlib import contextmanager
 from zipfile import ZipFile
 import glob
 import shutil
-from geoserver.catalog import Catalog
+import requests
+from requests.adapters import HTTPAdapter
+from geoserver.catalog import Catalog, UploadError
 from geoserver.resource import Coverage
 from geoserver.support import DimensionInfo
 
 
+class GeoserverSession(requests.Session):
+    """
+    requests.Session with a default (connect, read) timeout, the catalog does
+    not pass one. Uploads and harvests run inside long_requests(), where the
+    read timeout is upload_timeout: Geoserver answers them only after it has
+    indexed every granule.
+    """
+
+    def __init__(self, timeout=(10, 60), upload_timeout=(10, None)):
+        super().__init__()
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        # Per thread, the uploads of a run share the session
+        self.local = threading.local()
+
+    @contextmanager
+    def long_requests(self):
+        self.local.long = True
+        try:
+            yield
+        finally:
+            self.local.long = False
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.upload_timeout if getattr(self.local, "long", False) else self.timeout)
+        return super().request(method, url, **kwargs)
+
+
 class GeoserverClient(object):
 
     url = ''
@@ -17,7 +49,7 @@ class GeoserverClient(object):
     workspace = None
     workspace_name = ''
 
-    def __init__(self, url, user, pwd):
+    def __init__(self, url, user, pwd, timeout=(10, 60), upload_timeout=(10, None), pool_size=8):
         self.url = url
         self.user = user
         self.pwd = pwd
@@ -25,10 +57,24 @@ class GeoserverClient(object):
         self.workspace = None
         self.workspace_name = ''
 
+        # One keep-alive pool used by every call of the run, catalog included
+        self.session = GeoserverSession(timeout, upload_timeout)
+        self.session.auth = (self.user, self.pwd)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Stores of the workspace by name, read once and refreshed after creating one
+        self.stores = None
+        self.lock = threading.Lock()
+
     def connect(self):
+        if self.catalog:
+            return
         try:
             self.catalog = Catalog(
                 self.url, username=self.user, password=self.pwd)
+            self.catalog._session = self.session
             print("connected to Geoserver")
         except Exception as err:
             error = str(err).split()[50:61]
@@ -36,30 +82,36 @@ class GeoserverClient(object):
 
     def get_workspace(self, name):
         if self.catalog:
+            if self.workspace and self.workspace_name == name:
+                return
             self.workspace = self.catalog.get_workspace(name)
             self.workspace_name = name
+            self.stores = None
             print("Workspace found")
         else:
             print("Workspace not available")
             sys.exit()
 
+    def load_stores(self):
+        with self.lock:
+            if self.stores is None:
+                self.stores = {store.name: store for store in self.catalog.get_stores(self.workspace)}
+            return self.stores
+
+    def forget_stores(self):
+        with self.lock:
+            self.stores = None
+
     def get_store(self, store_name):
         if self.workspace:
-            """
-            store = self.catalog.get_store(store_name, self.workspace)
-            if store:
-                print("Store found")
-                return store
-            else:
-                print("Store not found:", store_name)
-                return None
-            """
             try:
-                store = self.catalog.get_store(store_name, self.workspace)
-                return store
+                store = self.load_stores().get(store_name)
             except Exception as err:
-                print("Store not found:", store_name)
+                print("Stores not found in:", self.workspace)
                 return None
+            if store is None:
+                print("Store not found:", store_name)
+            return store
         else:
             print("Workspace not found:", store_name)
             return None
@@ -67,40 +119,41 @@ class GeoserverClient(object):
     def get_stores(self):
         if self.workspace:
             try:
-                stores = self.catalog.get_stores(self.workspace)
+                stores = list(self.load_stores().values())
                 return stores
             except Exception as err:
                 print("Stores not found in:", self.workspace)
                 return None
 
-    def zip_files(self, folder, folder_properties, folder_tmp, zip_path):
-        if os.path.exists(folder) and os.path.exists(folder_properties):
+    def make_batches(self, files, max_batch_bytes):
+        # Splits the rasters in batches of at most max_batch_bytes (at least one file each)
+        batches = []
+        batch = []
+        batch_bytes = 0
+        for f in files:
+            size = os.path.getsize(f)
+            if batch and batch_bytes + size > max_batch_bytes:
+                batches.append(batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(f)
+            batch_bytes += size
+        if batch:
+            batches.append(batch)
+        return batches
 
-            if os.path.exists(folder_tmp):
-                shutil. rmtree(folder_tmp)
-            os.mkdir(folder_tmp)
+    def zip_files(self, files, folder_properties, zip_path, zip_name="mosaic.zip"):
+        # files is the list of rasters, they are written to the zip from their own paths
+        if len(files) > 0 and all(os.path.exists(f) for f in files) and os.path.exists(folder_properties):
 
-            # Copying files
             props = glob.glob(os.path.join(folder_properties, '*.properties'))
             if len(props) != 2:
                 print("check the properties file")
                 sys.exit()
-            for p in props:
-                f = p.rsplit(os.path.sep, 1)[-1]
-                print("Copying properties")
-                shutil.copyfile(p, os.path.join(folder_tmp, f))
-
-            # Copying rasters
-            files = glob.glob(os.path.join(folder, "*.*"))
-            for file in files:
-                f = file.rsplit(os.path.sep, 1)[-1]
-                shutil.copyfile(file, os.path.join(folder_tmp, f))
-
-            zip_name = "mosaic.zip"  # zip file name
-            list_files = glob.glob(os.path.join(folder_tmp, "*.*"))
+
             zip = ZipFile(os.path.join(zip_path, zip_name), mode="w")
             print("Zipping")
-            for f in list_files:
+            for f in props + list(files):
                 zip.write(f, f.rsplit(os.path.sep, 1)[-1])
             zip.close()
             zip_path = os.path.join(zip_path, zip_name)
@@ -108,15 +161,24 @@ class GeoserverClient(object):
             return zip_path
         else:
             print("Not zipped")
-            print(folder, os.path.exists(folder))
+            print("rasters", len(files), [f for f in files if not os.path.exists(f)])
             print(folder_properties, os.path.exists(folder_properties))
             return None
 
-    def create_mosaic(self, store_name, file, folder_properties, folder_tmp, zip_path):
-        output = self.zip_files(file, folder_properties, folder_tmp, zip_path)
+    def create_mosaic(self, store_name, files, folder_properties, zip_path, zip_name="mosaic.zip"):
+        output = self.zip_files(files, folder_properties, zip_path, zip_name)
         #print(output)
-        self.catalog.create_imagemosaic(store_name, output, workspace=self.workspace)
+        try:
+            with self.session.long_requests():
+                self.catalog.create_imagemosaic(store_name, output, workspace=self.workspace)
+        finally:
+            self.forget_stores()
+            if output is not None and os.path.exists(output):
+                os.remove(output)
         print(f"Mosaic store : {store_name} is created!")
+        self.configure_time(store_name)
+
+    def configure_time(self, store_name):
         store = self.catalog.get_store(store_name, workspace=self.workspace)
         url = self.url + "workspaces/" + self.workspace_name + \
             "/coveragestores/" + store_name + "/coverages/" + store_name + ".xml"
@@ -142,11 +204,65 @@ class GeoserverClient(object):
         print("Time Dimension is enabled")
         print("Done Successfully!")
 
-    def update_mosaic(self, store, file, folder_properties, folder_tmp, zip_path):
-        output = self.zip_files(file, folder_properties, folder_tmp, zip_path)
-        self.catalog.harvest_uploadgranule(output, store)
+    def update_mosaic(self, store, files, folder_properties, zip_path, zip_name="mosaic.zip"):
+        output = self.zip_files(files, folder_properties, zip_path, zip_name)
+        try:
+            with self.session.long_requests():
+                self.catalog.harvest_uploadgranule(output, store)
+        finally:
+            if output is not None and os.path.exists(output):
+                os.remove(output)
         print("Mosaic updated")
 
+    def place_files(self, files, folder):
+        # Hardlinks the files into folder, they are copied only when it is on another filesystem
+        os.makedirs(folder, exist_ok=True)
+        placed = []
+        for file in files:
+            target = os.path.join(folder, os.path.basename(file))
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(file, target)
+            except OSError:
+                shutil.copyfile(file, target)
+            placed.append(target)
+        return placed
+
+    def create_external_mosaic(self, store_name, files, folder_properties, mosaic_path, server_path):
+        """
+        Creates the mosaic store from a directory that Geoserver reads itself:
+        the properties and rasters are placed in mosaic_path/store_name and
+        Geoserver is pointed to the same directory as seen from the server
+        (server_path/store_name). Nothing is zipped or uploaded.
+        """
+        props = glob.glob(os.path.join(folder_properties, '*.properties'))
+        if len(props) != 2:
+            print("check the properties file")
+            sys.exit()
+        self.place_files(props + list(files), os.path.join(mosaic_path, store_name))
+
+        url = self.url + "workspaces/" + self.workspace_name + \
+            "/coveragestores/" + store_name + "/external.imagemosaic"
+        headers = {"Content-type": "text/plain", "Accept": "application/xml"}
+        with self.session.long_requests():
+            r = self.catalog.session.put(url, data="file://" + server_path.rstrip("/") + "/" + store_name, headers=headers)
+        # The catalog keeps the store list for a few seconds
+        self.catalog._cache.clear()
+        self.forget_stores()
+        if r.status_code != 201:
+            raise UploadError(r.text)
+        print(f"Mosaic store : {store_name} is created!")
+        self.configure_time(store_name)
+
+    def harvest_external(self, store, files, mosaic_path, server_path):
+        # Places the rasters in the mosaic directory and harvests each one from there
+        with self.session.long_requests():
+            for target in self.place_files(files, os.path.join(mosaic_path, store.name)):
+                self.catalog.harvest_externalgranule(
+                    "file://" + server_path.rstrip("/") + "/" + store.name + "/" + os.path.basename(target), store)
+        print("Mosaic harvested")
+
     def check(self, store):
         coverages = self.catalog.mosaic_coverages(store)
         granules = self.catalog.mosaic_granules(
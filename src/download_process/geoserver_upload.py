@@ -1,19 +1,21 @@
 import os
-import urllib.request
-import gzip
-import sys
 import re
+import json
+import time
 import shutil
-from pathlib import Path
+import tempfile
 import requests
 import xml.etree.ElementTree as ET
-from tools import DownloadProgressBar, Tools, Response
+from tools import Tools
 from geoserver_conexion.geoserver import GeoserverImport
+from geoserver_conexion.tool import GeoserverClient
+from publish_ledger import PublishLedger
+from run_state import RunState, get_run_state_file
 
 
 class UploadGeoserver():
 
-  def __init__(self, output_path, country, start_date, end_date, workspace):
+  def __init__(self, output_path, country, start_date, end_date, workspace, time_index_max_age=6 * 3600, batch_mb=256, upload_workers=2, mode="upload", reconcile=False):
      
     self.output_path = output_path
     self.country = country
@@ -21,148 +23,260 @@ class UploadGeoserver():
     self.end_date = end_date
     self.workspace = workspace
 
-    self.tmp_output_path = os.path.join(self.output_path, "tmp")
+    # Capas publicadas, una por carpeta de rasters recortados
+    self.target_dirs = ['TMAX', 'TMIN', 'SRAD', 'PREC']
 
     self.geoserver_user = os.getenv('GEO_USER')
     self.geoserver_pass = os.getenv('GEO_PASS')
     self.geoserver_url = os.getenv('GEO_URL')
 
+    # Con mode external el Geoserver lee los rasters de GEO_MOSAIC_DIR, que ve como GEO_MOSAIC_SERVER_DIR
+    self.mode = mode
+    self.mosaic_path = os.getenv('GEO_MOSAIC_DIR')
+    self.server_path = os.getenv('GEO_MOSAIC_SERVER_DIR')
+    if self.mode == "external" and not self.mosaic_path:
+      raise ValueError("GEO_MOSAIC_DIR must be set to publish in external mode")
+
     self.tools = Tools()
-    self.tools.create_dir(self.tmp_output_path)
 
+    # Tamaño máximo de cada zip subido y número de stores que se suben a la vez
+    self.batch_mb = batch_mb
+    self.upload_workers = upload_workers
+
+    # Un solo cliente (sesión con pool de conexiones y catálogo) para toda la corrida
+    self.geoclient = GeoserverClient(f"{self.geoserver_url}rest/", self.geoserver_user, self.geoserver_pass, pool_size=self.upload_workers + 1)
+
+    # Fechas publicadas de cada capa, se lee el GetCapabilities una sola vez por corrida
+    # y se guarda en output_path mientras tenga menos de time_index_max_age segundos
+    self.time_index = None
+    self.time_index_path = os.path.join(self.output_path, "geoserver_time_index.json")
+    self.time_index_max_age = time_index_max_age
+    # True once this run read the index from Geoserver, the next sources reuse it
+    self.time_index_fetched = False
+
+    # Registro local de lo publicado, con reconcile se compara con el Geoserver
+    self.ledger = PublishLedger(os.path.join(self.output_path, "geoserver_ledger.json"), self.get_time_index_key())
+    self.reconcile = reconcile
 
+    # Los días publicados pasan a 'published' en el estado de la corrida
+    self.run_state = RunState(get_run_state_file(self.output_path))
 
-  def get_dates_from_geoserver(self, layer):
+
+  def fetch_time_index(self):
     try:
         # Construir la URL
         url = f"{self.geoserver_url}{self.workspace}/wms?service=WMS&version=1.3.0&request=GetCapabilities"
         
         # Hacer la solicitud GET al servidor
-        response = requests.get(url)
+        response = self.geoclient.session.get(url)
         response.raise_for_status()  # Lanza un error si la solicitud no fue exitosa
         
         # Analizar el XML de la respuesta
         xmlDoc = ET.fromstring(response.content)
         
-        # Buscar todos los elementos 'Layer'
+        # Buscar todos los elementos 'Layer', el primero es la capa raíz del workspace
         layers = xmlDoc.findall(".//{http://www.opengis.net/wms}Layer")
-        dates = []
-
-        # Si hay más de un 'Layer', buscar el que coincide con el nombre de la capa
-        if len(layers) > 1:
-            for layer_elem in layers[1:]:
-                layer_name_elem = layer_elem.find("{http://www.opengis.net/wms}Name")
-                
-                if layer_name_elem is not None and layer_name_elem.text == layer:
-                    dimension_elem = layer_elem.find("{http://www.opengis.net/wms}Dimension")
-                    
-                    if dimension_elem is not None:
-                        dimension = dimension_elem.text
-                        time_intervals = dimension.split(",")
-                        
-                        # Procesar las fechas
-                        dates = [date.split("T")[0] for date in time_intervals]
-                    break
-            return dates
-        else:
-            print(f"The workspace {self.workspace}, does not have the layer selected: {layer}")
-            return []
+        index = {}
+
+        for layer_elem in layers[1:]:
+            layer_name_elem = layer_elem.find("{http://www.opengis.net/wms}Name")
+            if layer_name_elem is None:
+                continue
+
+            dates = []
+            dimension_elem = layer_elem.find("{http://www.opengis.net/wms}Dimension")
+            if dimension_elem is not None and dimension_elem.text:
+                # Procesar las fechas
+                dates = [date.split("T")[0] for date in dimension_elem.text.strip().split(",")]
+            index[layer_name_elem.text] = dates
+
+        return index
     
-    except requests.exceptions.RequestException as error:
+    except (requests.exceptions.RequestException, ET.ParseError) as error:
         print(f"Error getting available rasters from workspace: {self.workspace}")
         print(error)
-        return []
+        return None
+
+  def get_time_index_key(self):
+    return f"{self.geoserver_url}{self.workspace}"
 
-  def importGeoserver(self):
+  def load_time_index(self):
+    if not os.path.exists(self.time_index_path):
+      return None
+    try:
+      with open(self.time_index_path, "r") as f:
+        entry = json.load(f).get(self.get_time_index_key())
+    except (OSError, ValueError):
+      return None
+
+    # Solo sirve si es reciente, otros procesos pueden haber publicado después
+    if entry is None or time.time() - entry["fetched"] > self.time_index_max_age:
+      return None
+    return entry
+
+  def save_time_index(self):
+    data = {}
+    if os.path.exists(self.time_index_path):
+      try:
+        with open(self.time_index_path, "r") as f:
+          data = json.load(f)
+      except (OSError, ValueError):
+        data = {}
+    data[self.get_time_index_key()] = self.time_index
+
+    tmp_path = f"{self.time_index_path}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(data, f)
+    os.replace(tmp_path, self.time_index_path)
+
+  def get_time_index(self, refresh=False):
+    """
+    Published dates of every layer. With refresh the GetCapabilities is read
+    again even if the index was already loaded in this run or in the cache.
+    Returns None when the Geoserver could not be read.
+    """
+    if self.time_index is None and not refresh:
+      self.time_index = self.load_time_index()
+      if self.time_index is not None:
+        print("Using the cached Geoserver time index")
+
+    if self.time_index is None or refresh:
+      layers = self.fetch_time_index()
+      if layers is None:
+        # No se guarda para volver a consultar en la siguiente corrida
+        return None
+      self.time_index = {"fetched": time.time(), "layers": layers}
+      self.time_index_fetched = True
+      self.save_time_index()
+    return self.time_index["layers"]
+
+  def add_published_dates(self, layer_dates):
+    # Agrega al índice las fechas que se acaban de publicar
+    if self.time_index is None:
+      return
+    for layer, dates in layer_dates.items():
+      published = set(self.time_index["layers"].get(layer, []))
+      published.update(dates)
+      self.time_index["layers"][layer] = sorted(published)
+    self.save_time_index()
+
+  def get_layer_files(self, layers=None):
+    """
+    Rasters of each layer in the output folders as {layer: {YYYY-MM-DD: path}}.
+    The files are referenced where they are, nothing is copied.
+    """
+    layer_files = {}
+    for layer in self.target_dirs:
+      if layers is not None and layer not in layers:
+        continue
+      layer_path = os.path.join(self.output_path, layer)
+      if not os.path.isdir(layer_path):  # Verifica si es un directorio
+        continue
+
+      files = {}
+      for file in sorted(os.listdir(layer_path)):
+        # Use a regex to extract the date from the filename (assuming format PREFIX_YYYYMMDD.tif)
+        match = re.match(r'.*_(\d{8})\.tif$', file)
+        if match:
+          file_date = match.group(1)  # 'YYYYMMDD'
+          files[f"{file_date[:4]}-{file_date[4:6]}-{file_date[6:]}"] = os.path.join(layer_path, file)
+        else:
+          print(f"The file {file} does not follow the expected format.")
+      layer_files[layer] = files
+    return layer_files
+
+  def importGeoserver(self, layer_files):
     try:
       root_path  = os.path.dirname(os.path.realpath(__file__))
       geoserver_path= os.path.join(root_path, "geoserver_conexion")
-      layer_path= os.path.join(geoserver_path, "layers")
-      zip_path= os.path.join(geoserver_path, "zip")
-      tmp_path= os.path.join(geoserver_path, "tmp")
-      self.tools.create_dir(tmp_path)
-      self.tools.create_dir(zip_path)
-      self.tools.create_dir(layer_path)
-      
-      # Copiar solo las carpetas de TMAX, TMIN, SRAD y PREC
-      target_dirs = ['TMAX', 'TMIN', 'SRAD', 'PREC']
-      
-      for target_dir in target_dirs:
-            src_dir = os.path.join(self.tmp_output_path, target_dir)
-            if os.path.isdir(src_dir):  # Verifica si es un directorio
-                # Copiar la carpeta y su contenido
-                shutil.copytree(src_dir, os.path.join(layer_path, target_dir), dirs_exist_ok=True)
-
-      geoserver = GeoserverImport(self.workspace, self.geoserver_user, self.geoserver_pass, self.geoserver_url)
-      result = geoserver.connect_geoserver()
-      for file in os.listdir(self.tmp_output_path):
-       file_path = os.path.join(self.tmp_output_path, file)
-       shutil.rmtree(file_path)
-      shutil.rmtree(self.tmp_output_path)
-      shutil.rmtree(tmp_path)
-      shutil.rmtree(zip_path)
-      shutil.rmtree(layer_path)
-      if not result:
+      # Carpeta de zips propia de esta corrida, otras corridas en la misma máquina no la comparten
+      self.tools.create_dir(os.path.join(geoserver_path, "zip"))
+      zip_path = tempfile.mkdtemp(prefix="run_", dir=os.path.join(geoserver_path, "zip"))
+
+      geoserver = GeoserverImport(self.workspace, self.geoserver_user, self.geoserver_pass, self.geoserver_url,
+                                  max_batch_bytes=self.batch_mb * 1024 * 1024, max_uploads=self.upload_workers,
+                                  mode=self.mode, mosaic_path=self.mosaic_path, server_path=self.server_path,
+                                  client=self.geoclient, zip_path=zip_path)
+      try:
+        result = geoserver.connect_geoserver({layer: list(files.values()) for layer, files in layer_files.items()})
+      finally:
+        shutil.rmtree(zip_path, ignore_errors=True)
+      if result is None:
          print("Error saving")
          return
 
+      # Solo se registran las fechas de los lotes que llegaron al Geoserver
+      published = {}
+      for layer, files in layer_files.items():
+        landed = set(result.get(layer, []))
+        published[layer] = [date for date, file_path in files.items() if file_path in landed]
+        for date in published[layer]:
+          self.ledger.record(layer, date, files[date])
+        source = "CHIRPS" if layer == "PREC" else "ERA5"
+        self.run_state.set_many(source, layer, [date.replace("-", "") for date in published[layer]], "published")
+      self.ledger.save()
+      self.add_published_dates(published)
+
+      failed = sum(len(files) - len(published[layer]) for layer, files in layer_files.items())
+      if failed > 0:
+        print(f"Error saving {failed} rasters, they will be uploaded in the next run")
+        return
       print("Rasters were saved successfully")
     except Exception as e:
       print(e)
 
 
-  def remove_duplicates(self, obj):
-    # Iterate over the keys (layers) in the object
-    for layer, dates in obj.items():
-      # Path to the subfolder corresponding to the layer
-      layer_path = os.path.join(self.tmp_output_path, layer)
-      
-      # Check if the subfolder exists
-      if not os.path.exists(layer_path):
-          print(f"The folder {layer_path} does not exist.")
-          continue
-      
-      # Get files inside the subfolder
-      for file in os.listdir(layer_path):
-        file_path = os.path.join(layer_path, file)
+  def reconcile_ledger(self, layer_files):
+    """
+    Compares the ledger with the dates published in Geoserver: dates missing in
+    the server are removed from the ledger and published dates that are not in
+    the ledger are added with the checksum of the local raster. The cached time
+    index is used while it is fresh, with reconcile it is read from Geoserver
+    once per run and reused for the layers of the next sources.
+    """
+    layers = self.get_time_index(refresh=self.reconcile and not self.time_index_fetched)
+    if layers is None:
+      print("The publish ledger could not be reconciled with Geoserver")
+      return
 
-        # Use a regex to extract the date from the filename (assuming format PREFIX_YYYYMMDD.tif)
-        match = re.match(r'.*_(\d{8})\.tif', file)
-
-        if match:
-            # Extract date in YYYY-MM-DD format
-            file_date = match.group(1)  # 'YYYYMMDD'
-            formatted_date = f"{file_date[:4]}-{file_date[4:6]}-{file_date[6:]}"  # Convert to 'YYYY-MM-DD'
-
-            # Check if the file date is in the object's list of dates
-            if formatted_date in dates:
-                # If the date is found in the object, delete the file
-                print(f"Removing duplicate file: {file_path}")
-                os.remove(file_path)
-        else:
-            print(f"The file {file} does not follow the expected format.")
+    for layer, files in layer_files.items():
+      server_dates = set(layers.get(layer, []))
+      for date in self.ledger.dates(layer) - server_dates:
+        self.ledger.forget(layer, date)
+      for date in (server_dates - self.ledger.dates(layer)) & set(files):
+        self.ledger.record(layer, date, files[date])
+    self.ledger.save()
+    print("Publish ledger reconciled with Geoserver")
 
 
-  def main(self):
+  def remove_duplicates(self, layer_files):
+    # Deja solo los rasters que no están en el registro o cambiaron desde que se publicaron
+    pending = {}
+    for layer, files in layer_files.items():
+      files = {date: file_path for date, file_path in files.items() if not self.ledger.is_published(layer, date, file_path)}
+      skipped = len(layer_files[layer]) - len(files)
+      if skipped > 0:
+        print(f"Skipping {skipped} rasters of {layer} already on the geoserver")
+      if files:
+        pending[layer] = files
+    return pending
 
-    layer_dates = {}
 
-    target_dirs = ['TMAX', 'TMIN', 'SRAD', 'PREC']
-      
-    for target_dir in target_dirs:
-      src_dir = os.path.join(self.output_path, target_dir)
-      if os.path.isdir(src_dir):  # Verifica si es un directorio
-        # Copiar la carpeta y su contenido
-        shutil.copytree(src_dir, os.path.join(self.tmp_output_path, target_dir), dirs_exist_ok=True)
+  def main(self, layers=None):
+    # layers limits the upload to some of the target folders, e.g. when only one source is ready
+    layer_files = self.get_layer_files(layers)
 
-    if len(os.listdir(self.tmp_output_path)) > 0:
-      for layer in os.listdir(self.tmp_output_path):
-        layer_dates[layer] = self.get_dates_from_geoserver(layer)
-      self.remove_duplicates(layer_dates)
-      if self.tools.has_file(self.tmp_output_path):
-        self.importGeoserver()
+    if any(layer_files.values()):
+      # Las capas sin registro (primera carga de la capa) toman lo publicado del Geoserver.
+      # Se revisa por capa, cada fuente llama a main con sus propias capas
+      unknown = {layer: files for layer, files in layer_files.items() if self.reconcile or not self.ledger.dates(layer)}
+      if unknown:
+        self.reconcile_ledger(unknown)
+      pending = self.remove_duplicates(layer_files)
+      if pending:
+        self.importGeoserver(pending)
       else:
-        shutil.rmtree(self.tmp_output_path)
         print("All files are already on the geoserver")
+      self.ledger.save()
     else:
-      print("There is no data to import")
\ No newline at end of file
+      print("There is no data to import")
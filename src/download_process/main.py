@@ -1,10 +1,71 @@
+import os
+import sys
+import glob
 import argparse
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tools import Tools
 from chirps_data import ChirpsData
 from era5_data import Era5Data
 from geoserver_upload import UploadGeoserver
 from data_extractor import DataExtractor
+from run_state import RunState, get_run_state_file
+from datacube import DataCube
+from catch_up import CatchUp
+
+
+def run_stage(report, name, function):
+  # Runs one stage and records its state, duration and error in the shared report
+  print(f"[{name}] started")
+  start = time.time()
+  try:
+    function()
+    report[name] = ("done", time.time() - start, None)
+  except Exception as e:
+    traceback.print_exc()
+    report[name] = ("failed", time.time() - start, str(e))
+  print(f"[{name}] {report[name][0]} in {report[name][1]:.0f}s")
+  return report[name][0] == "done"
+
+
+def print_report(report):
+  print("Run summary")
+  for name, (state, duration, error) in report.items():
+    print(f"\t{name}: {state} in {duration:.0f}s" + (f" -> {error}" if error else ""))
+
+
+def print_status(output_path, start_date, end_date):
+  # Estado de cada fuente y variable en el rango de fechas, sin correr el pipeline
+  start_day = start_date.replace("-", "") + "01" if start_date else None
+  end_day = end_date.replace("-", "") + "31" if end_date else None
+  run_state = RunState(get_run_state_file(output_path))
+  summary = run_state.summary(start_day, end_day)
+  if not summary:
+    print("There is no run state for the date range")
+  for (source, variable), states in summary.items():
+    print(f"{source} {variable}: " + ", ".join(f"{state} {states[state]}" for state in RunState.STATES if state in states))
+  for source, variable, day, state, error in run_state.days(start_day=start_day, end_day=end_day):
+    if error:
+      print(f"\t{source} {variable} {day} ({state}): {error}")
+  run_state.close()
+
+
+def merge_shards(output_path, country, start_date, end_date, cube):
+  # Une el estado de los shards y, con --cube, agrega al datacube los rasters que escribieron
+  run_state = RunState(get_run_state_file(output_path))
+  for shard_file in sorted(glob.glob(os.path.join(output_path, "run_state.shard_*.db"))):
+    print(f"\tMerging {shard_file}")
+    run_state.merge(shard_file)
+  run_state.close()
+
+  if cube:
+    datacube = DataCube(os.path.join(output_path, "cube"), country)
+    dates = Tools().generate_dates(start_date, end_date)
+    for variable in ["PREC", "TMAX", "TMIN", "SRAD"]:
+      raster_files = [os.path.join(output_path, variable, f"{variable}_{date.replace('-', '')}.tif") for date in dates]
+      datacube.append_rasters([raster_file for raster_file in raster_files if os.path.exists(raster_file)])
 
 
 def main():
@@ -14,12 +75,37 @@ def main():
     parser = argparse.ArgumentParser(description="Download satellite data packages")
 
     parser.add_argument("-o", "--outputs", help="Outputs path", required=True)
-    parser.add_argument("-s", "--startDate", help="Start date to download example: 2024-07", required=True)
-    parser.add_argument("-e", "--endDate", help="End date to download example: 2024-09", required=True)
+    parser.add_argument("-s", "--startDate", help="Start date to download example: 2024-07 (not needed with --catch_up)", required=False)
+    parser.add_argument("-e", "--endDate", help="End date to download example: 2024-09 (not needed with --catch_up)", required=False)
     parser.add_argument("-c", "--country", help="Country", required=True)
     parser.add_argument("-d", "--download", help="Download data path", required=True)
     parser.add_argument("-w", "--workspace", help="Geoserver workspace", required=False)
     parser.add_argument("-i", "--input_csv", help="Path to input CSV with coordinates", required=False)
+    parser.add_argument("--stream", help="Download, decompress and clip CHIRPS files in a single pass", action="store_true")
+    parser.add_argument("--keep_global", help="Keep the global CHIRPS rasters when --stream is used", action="store_true")
+    parser.add_argument("--fused", help="Convert ERA5 NetCDFs straight to clipped rasters, without global intermediate rasters", action="store_true")
+    parser.add_argument("--cds_requests", help="Number of ERA5 requests queued at once in the CDS", type=int, default=8)
+    parser.add_argument("--cds_months", help="Number of months merged in each ERA5 request", type=int, default=3)
+    parser.add_argument("--era5_area", help="Download and keep only the country bounding box of ERA5", action="store_true")
+    parser.add_argument("--no_area_request", help="With --era5_area, download global ERA5 files and cut the area after the download", action="store_true")
+    parser.add_argument("--from_zip", help="Convert the ERA5 NetCDFs read straight from the downloaded zips, without extracting them", action="store_true")
+    parser.add_argument("--cube", help="Also store the clipped grids in per-variable NetCDF datacubes (<outputs>/cube) and extract the points from them", action="store_true")
+    parser.add_argument("--incremental", help="Add the extracted days to the existing station CSVs instead of rewriting them", action="store_true")
+    parser.add_argument("--output_format", help="Output of the station series: one CSV per station or a single Parquet dataset", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--sampling", help="How the station values are read from the grid: cell of the point, bilinear interpolation or mean of the surrounding cells", choices=["nearest", "bilinear", "buffer"], default="nearest")
+    parser.add_argument("--buffer_cells", help="Cells around the station cell averaged with --sampling buffer", type=int, default=1)
+    parser.add_argument("--geo_batch_mb", help="Maximum size in MB of each zip uploaded to Geoserver", type=int, default=256)
+    parser.add_argument("--geo_uploads", help="Number of Geoserver stores uploaded at the same time", type=int, default=2)
+    parser.add_argument("--geo_mode", help="upload: send zips through the Geoserver REST API, external: Geoserver harvests the rasters from GEO_MOSAIC_DIR", choices=["upload", "external"], default="upload")
+    parser.add_argument("--geo_reconcile", help="Compare the local publish ledger with the dates published in Geoserver before uploading", action="store_true")
+    parser.add_argument("--workers", help="Number of parallel CHIRPS downloads", type=int, default=4)
+    parser.add_argument("--processes", help="Number of processes of each source used to convert and clip the rasters", type=int, default=1)
+    parser.add_argument("--catch_up", help="Process only the days missing since the last clipped day up to the latest day each source has available", action="store_true")
+    parser.add_argument("--era5_lag", help="With --catch_up, days ERA5 is published behind today", type=int, default=8)
+    parser.add_argument("--catch_up_days", help="With --catch_up, recent days checked again for gaps", type=int, default=31)
+    parser.add_argument("--shard", help="Process only the slice i of N of the months of the date range, example: 2/4", required=False)
+    parser.add_argument("--merge", help="After every --shard run: merge their state, build the datacube, extract the stations and publish the whole date range", action="store_true")
+    parser.add_argument("--status", help="Print the state of every source, variable and day in the date range and exit", action="store_true")
 
 
     args = parser.parse_args()
@@ -41,23 +127,143 @@ def main():
 
     input_csv = args.input_csv
 
+    stream = args.stream
+
+    keep_global = args.keep_global
+
+    workers = args.workers
+
+    processes = args.processes
+
+    fused = args.fused
+
+    cds_requests = args.cds_requests
+
+    cds_months = args.cds_months
+
+    era5_area = args.era5_area
+
+    area_request = not args.no_area_request
+
+    from_zip = args.from_zip
+
+    cube = args.cube
+
+    incremental = args.incremental
+    output_format = args.output_format
+    sampling = args.sampling
+    buffer_cells = args.buffer_cells
+    geo_batch_mb = args.geo_batch_mb
+    geo_uploads = args.geo_uploads
+    geo_mode = args.geo_mode
+    geo_reconcile = args.geo_reconcile
+
+    if args.status:
+      print_status(output_path, start_date, end_date)
+      return
+
+    # Días pendientes de cada fuente, sin nada nuevo la corrida termina aquí
+    plan = None
+    if args.catch_up:
+      print("Looking for missing days")
+      catch_up = CatchUp(output_path, era5_lag=args.era5_lag, lookback_days=args.catch_up_days)
+      plan = catch_up.plan()
+      catch_up.close()
+      if not plan:
+        print("Everything is up to date")
+        return
+      days = sorted(day for source_days in plan.values() for day in source_days)
+      start_date, end_date = days[0][:7], days[-1][:7]
+    elif not start_date or not end_date:
+      raise ValueError("--startDate and --endDate are required without --catch_up")
+
     tools = Tools()
     tools.validate_dates(start_date, end_date)
 
-    cd = ChirpsData(output_path, country, start_date, end_date, download_path)
-    cd.main()
+    # Con --shard este nodo solo descarga, convierte y recorta su parte de los meses.
+    # La extracción, el datacube y la publicación se hacen una sola vez con --merge
+    shard = None
+    if args.shard:
+      if args.catch_up or args.merge:
+        raise ValueError("--shard can not be used with --catch_up or --merge")
+      shard = tools.parse_shard(args.shard)
+      shard_range = tools.shard_range(start_date, end_date, shard)
+      if shard_range is None:
+        print(f"The shard {args.shard} has no months in the date range")
+        return
+      start_date, end_date = shard_range
+      print(f"Shard {args.shard}: {start_date} to {end_date}")
+
+      # Cada shard descarga en su propia carpeta
+      download_path = os.path.join(download_path, f"shard_{shard[0]}_of_{shard[1]}")
+      cube = False
+      input_csv = None
+      workspace = None
 
-    e5 = Era5Data(output_path, country, start_date, end_date, download_path)
-    e5.main()
+    def get_range(source):
+      # Meses y días de la fuente, todo el rango sin --catch_up
+      if plan is None:
+        return start_date, end_date, None
+      return plan[source][0][:7], plan[source][-1][:7], plan[source]
 
+    # Con --merge no corre ninguna fuente, ya lo hicieron los shards
+    run_sources = [] if args.merge else [source for source in ["CHIRPS", "ERA5"] if plan is None or source in plan]
+
+    sources = {}
+    if "CHIRPS" in run_sources:
+      chirps_start, chirps_end, chirps_days = get_range("CHIRPS")
+      cd = ChirpsData(output_path, country, chirps_start, chirps_end, download_path, stream=stream, keep_global=keep_global, workers=workers, cube=cube, days=chirps_days, processes=processes, shard=shard)
+      sources["CHIRPS"] = (cd.main, ["PREC"])
+
+    if "ERA5" in run_sources:
+      era5_start, era5_end, era5_days = get_range("ERA5")
+      e5 = Era5Data(output_path, country, era5_start, era5_end, download_path, fused=fused, cds_requests=cds_requests, months_per_request=cds_months, area=era5_area, area_request=area_request, from_zip=from_zip, cube=cube, days=era5_days, processes=processes, shard=shard)
+      sources["ERA5"] = (e5.main, ["TMAX", "TMIN", "SRAD"])
+
+    extractor = None
     if input_csv:
-      extractor = DataExtractor(output_path, input_csv, start_date, end_date)
-      extractor.process()
+      extractor = DataExtractor(output_path, input_csv, start_date, end_date, country=country, cube=cube, incremental=incremental, output_format=output_format,
+                                sampling=sampling, buffer_cells=buffer_cells)
 
+    geo = None
     if workspace:
-      geo = UploadGeoserver(output_path, country, start_date, end_date, workspace)
-      geo.main()
+      geo = UploadGeoserver(output_path, country, start_date, end_date, workspace, batch_mb=geo_batch_mb, upload_workers=geo_uploads, mode=geo_mode, reconcile=geo_reconcile)
+
+    # Las fuentes son independientes y corren a la vez, cada una con sus propios workers.
+    # Apenas termina una se extraen y publican sus variables
+    report = {}
+    followups = []
+
+    if args.merge:
+      run_stage(report, "Merge", lambda: merge_shards(output_path, country, start_date, end_date, cube))
+      if extractor:
+        run_stage(report, "Extraction", extractor.extract)
+      if geo:
+        run_stage(report, "Upload", geo.main)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(sources) * 2)) as executor, ThreadPoolExecutor(max_workers=1) as uploads:
+      futures = {executor.submit(run_stage, report, name, function): name for name, (function, _) in sources.items()}
+      for future in as_completed(futures):
+        name = futures[future]
+        if not future.result():
+          continue
+        layers = sources[name][1]
+        if extractor:
+          followups.append(executor.submit(run_stage, report, f"{name} extraction", lambda layers=layers: extractor.extract(layers)))
+        if geo:
+          # Las cargas al Geoserver se hacen una a la vez, comparten el registro y el cliente
+          followups.append(uploads.submit(run_stage, report, f"{name} upload", lambda layers=layers: geo.main(layers)))
+
+      for future in followups:
+        future.result()
+
+    if extractor:
+      run_stage(report, "Station outputs", extractor.process)
 
+    print_report(report)
+    # Cron y los shards solo ven el código de salida
+    if any(state == "failed" for state, _, _ in report.values()):
+      sys.exit(1)
       
   except ValueError as e:
       print(f"Error: {e}")
@@ -0,0 +1,88 @@
+import os
+import re
+import json
+import threading
+
+
+class Manifest():
+  """
+  In-memory index of the files of the data directories.
+
+  Each directory is listed once (or read from the persisted manifest while the
+  directory mtime is unchanged) and every existence check is answered from a
+  set. Files written by the pipeline are added with add() so the index stays
+  valid during the run.
+  """
+
+  def __init__(self, manifest_path=None):
+    self.manifest_path = manifest_path
+    self.directories = {}
+    self.persisted = {}
+    # Reentrante: add, remove y dates usan files() con el lock tomado
+    self.lock = threading.RLock()
+
+    if self.manifest_path is not None and os.path.exists(self.manifest_path):
+      try:
+        with open(self.manifest_path, "r") as f:
+          self.persisted = json.load(f)
+      except (OSError, ValueError):
+        print(f"\tInvalid manifest, it will be rebuilt: {self.manifest_path}")
+        self.persisted = {}
+
+  def list_directory(self, directory):
+    if not os.path.isdir(directory):
+      return set()
+
+    # El manifiesto guardado sirve mientras el directorio no haya cambiado
+    mtime = os.path.getmtime(directory)
+    entry = self.persisted.get(directory)
+    if entry is not None and entry["mtime"] == mtime:
+      return set(entry["files"])
+
+    with os.scandir(directory) as entries:
+      return set(e.name for e in entries if e.is_file())
+
+  def files(self, directory):
+    directory = os.path.abspath(directory)
+    with self.lock:
+      if directory not in self.directories:
+        self.directories[directory] = self.list_directory(directory)
+      return self.directories[directory]
+
+  def exists(self, path):
+    return os.path.basename(path) in self.files(os.path.dirname(path))
+
+  def add(self, path):
+    # Con el lock, save puede estar recorriendo el mismo set desde otro hilo
+    with self.lock:
+      self.files(os.path.dirname(path)).add(os.path.basename(path))
+
+  def remove(self, path):
+    with self.lock:
+      self.files(os.path.dirname(path)).discard(os.path.basename(path))
+
+  def dates(self, directory, pattern=r"(\d{8})"):
+    # Fechas YYYYMMDD presentes en los nombres de los archivos del directorio
+    dates = set()
+    with self.lock:
+      names = list(self.files(directory))
+    for name in names:
+      match = re.search(pattern, name)
+      if match:
+        dates.add(match.group(1))
+    return dates
+
+  def save(self):
+    if self.manifest_path is None:
+      return
+
+    data = dict(self.persisted)
+    with self.lock:
+      for directory, files in self.directories.items():
+        if os.path.isdir(directory):
+          data[directory] = {"mtime": os.path.getmtime(directory), "files": sorted(files)}
+
+    tmp_path = f"{self.manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(data, f)
+    os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,76 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+
+class PublishLedger():
+  """
+  Local record of the granules published in each Geoserver store.
+
+  Every entry keeps the date, the checksum, size and mtime of the raster and
+  the upload time, so knowing what is left to publish is a lookup in memory.
+  A raster whose content changed since it was published is published again.
+  The checksum is only computed when the size or mtime of the file changed.
+  """
+
+  def __init__(self, ledger_path, key):
+    self.ledger_path = ledger_path
+    # Ledger of one Geoserver workspace, the file can hold several
+    self.key = key
+    self.data = {}
+    self.lock = threading.Lock()
+
+    if os.path.exists(self.ledger_path):
+      try:
+        with open(self.ledger_path, "r") as f:
+          self.data = json.load(f)
+      except (OSError, ValueError):
+        print(f"\tInvalid publish ledger, it will be rebuilt: {self.ledger_path}")
+        self.data = {}
+    self.stores = self.data.setdefault(self.key, {})
+
+  def dates(self, store):
+    return set(self.stores.get(store, {}))
+
+  def checksum(self, file):
+    sha1 = hashlib.sha1()
+    with open(file, "rb") as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+  def is_published(self, store, date, file):
+    entry = self.stores.get(store, {}).get(date)
+    if entry is None:
+      return False
+
+    stat = os.stat(file)
+    if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+      return True
+
+    # El archivo se reescribió, se publica de nuevo solo si cambió el contenido
+    if entry["checksum"] != self.checksum(file):
+      return False
+    with self.lock:
+      entry["size"], entry["mtime"] = stat.st_size, stat.st_mtime_ns
+    return True
+
+  def record(self, store, date, file):
+    stat = os.stat(file)
+    entry = {"checksum": self.checksum(file), "size": stat.st_size, "mtime": stat.st_mtime_ns,
+             "uploaded": datetime.now().isoformat(timespec="seconds")}
+    with self.lock:
+      self.stores.setdefault(store, {})[date] = entry
+
+  def forget(self, store, date):
+    with self.lock:
+      self.stores.get(store, {}).pop(date, None)
+
+  def save(self):
+    tmp_path = f"{self.ledger_path}.tmp"
+    with self.lock:
+      with open(tmp_path, "w") as f:
+        json.dump(self.data, f)
+    os.replace(tmp_path, self.ledger_path)
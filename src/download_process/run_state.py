@@ -0,0 +1,114 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+
+def get_run_state_file(output_path, shard=None):
+  # Cada shard (i, N) escribe su propia base, el paso de merge las une en run_state.db
+  if shard is None:
+    return os.path.join(output_path, "run_state.db")
+  return os.path.join(output_path, f"run_state.shard_{shard[0]}_of_{shard[1]}.db")
+
+
+class RunState():
+  """
+  Persistent state of the (source, variable, day) tasks of the pipeline.
+
+  Every task moves forward through STATES and is stored in a SQLite database,
+  so a restarted run can skip what is already done and the state of any day
+  can be queried. A state never goes back: writing 'downloaded' for a day that
+  is already 'clipped' is ignored. Errors are recorded next to the state.
+  """
+
+  STATES = ["pending", "downloaded", "converted", "clipped", "published"]
+
+  def __init__(self, db_path):
+    self.db_path = db_path
+    self.lock = threading.Lock()
+
+    # Varios procesos pueden usar la misma base, WAL permite leer mientras otro escribe
+    self.connection = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+    with self.lock, self.connection:
+      self.connection.execute("PRAGMA journal_mode=WAL")
+      self.connection.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                                   source TEXT, variable TEXT, day TEXT,
+                                   state TEXT, rank INTEGER, error TEXT, updated TEXT,
+                                   PRIMARY KEY (source, variable, day))""")
+
+  def set(self, source, variable, day, state):
+    self.set_many(source, variable, [day], state)
+
+  def set_many(self, source, variable, days, state):
+    # day en formato YYYYMMDD, solo se avanza a un estado posterior
+    updated = datetime.now().isoformat(timespec="seconds")
+    rows = [(source, variable, day, state, self.STATES.index(state), updated) for day in days]
+    with self.lock, self.connection:
+      self.connection.executemany("""INSERT INTO tasks (source, variable, day, state, rank, error, updated)
+                                     VALUES (?, ?, ?, ?, ?, NULL, ?)
+                                     ON CONFLICT (source, variable, day) DO UPDATE
+                                     SET state = excluded.state, rank = excluded.rank, error = NULL, updated = excluded.updated
+                                     WHERE excluded.rank > tasks.rank""", rows)
+
+  def fail(self, source, variable, day, error):
+    updated = datetime.now().isoformat(timespec="seconds")
+    with self.lock, self.connection:
+      self.connection.execute("""INSERT INTO tasks (source, variable, day, state, rank, error, updated)
+                                 VALUES (?, ?, ?, 'pending', 0, ?, ?)
+                                 ON CONFLICT (source, variable, day) DO UPDATE
+                                 SET error = excluded.error, updated = excluded.updated""",
+                              (source, variable, day, str(error), updated))
+
+  def get(self, source, variable, day):
+    with self.lock:
+      row = self.connection.execute("SELECT state FROM tasks WHERE source = ? AND variable = ? AND day = ?",
+                                    (source, variable, day)).fetchone()
+    return row[0] if row else None
+
+  def reached(self, source, variable, day, state):
+    current = self.get(source, variable, day)
+    return current is not None and self.STATES.index(current) >= self.STATES.index(state)
+
+  def days(self, source=None, variable=None, state=None, start_day=None, end_day=None):
+    """
+    Returns the tasks as (source, variable, day, state, error) tuples, filtered
+    by any of source, variable, state and the day range (YYYYMMDD, inclusive).
+    """
+    query = "SELECT source, variable, day, state, error FROM tasks WHERE 1 = 1"
+    params = []
+    for column, value, operator in [("source", source, "="), ("variable", variable, "="), ("state", state, "="),
+                                    ("day", start_day, ">="), ("day", end_day, "<=")]:
+      if value is not None:
+        query += f" AND {column} {operator} ?"
+        params.append(value)
+    with self.lock:
+      return self.connection.execute(query + " ORDER BY source, variable, day", params).fetchall()
+
+  def merge(self, db_path):
+    """
+    Adds the tasks of another run state database (e.g. of a shard). States
+    only move forward, so merging the same database twice changes nothing.
+    """
+    with self.lock:
+      self.connection.execute("ATTACH DATABASE ? AS other", (db_path,))
+      try:
+        with self.connection:
+          self.connection.execute("""INSERT INTO tasks (source, variable, day, state, rank, error, updated)
+                                     SELECT source, variable, day, state, rank, error, updated FROM other.tasks WHERE 1 = 1
+                                     ON CONFLICT (source, variable, day) DO UPDATE
+                                     SET state = excluded.state, rank = excluded.rank, error = excluded.error, updated = excluded.updated
+                                     WHERE excluded.rank > tasks.rank""")
+      finally:
+        self.connection.execute("DETACH DATABASE other")
+
+  def summary(self, start_day=None, end_day=None):
+    # Número de días en cada estado por fuente y variable
+    counts = {}
+    for source, variable, day, state, error in self.days(start_day=start_day, end_day=end_day):
+      states = counts.setdefault((source, variable), {})
+      states[state] = states.get(state, 0) + 1
+    return counts
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
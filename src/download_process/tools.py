@@ -2,6 +2,7 @@ import os
 from datetime import datetime, timedelta
 from tqdm import tqdm
 import shutil
+from contextlib import contextmanager
 
 class DownloadProgressBar(tqdm):
     def update_to(self, b=1, bsize=1, tsize=None):
@@ -45,6 +46,30 @@ class Tools():
     return dates
 
 
+  def parse_shard(self, spec):
+    # "i/N" -> (i, N), con 1 <= i <= N
+    try:
+      index, count = map(int, spec.split("/"))
+    except ValueError:
+      raise ValueError(f"Invalid shard {spec}, it must be i/N, example: 2/4")
+    if count < 1 or not 1 <= index <= count:
+      raise ValueError(f"Invalid shard {spec}, i must be between 1 and N")
+    return index, count
+
+  def shard_range(self, start_date, end_date, shard):
+    """
+    Months (start, end) in format 'YYYY-MM' of the shard (i, N) of the range.
+    The months of generate_dates are split in N contiguous slices of almost the
+    same size, so the shards never share a month and always get the same one.
+    Returns None when the shard has no months (N greater than the months).
+    """
+    months = sorted(set(date[:7] for date in self.generate_dates(start_date, end_date)))
+    index, count = shard
+    shard_months = months[(index - 1) * len(months) // count:index * len(months) // count]
+    if len(shard_months) == 0:
+      return None
+    return shard_months[0], shard_months[-1]
+
   def create_dir(self, path):
     if not os.path.exists(path):
       os.makedirs(path)
@@ -59,6 +84,19 @@ class Tools():
         d = os.path.join(dest, item)
         shutil.copytree(s, d)
   
+  @contextmanager
+  def atomic_path(self, path):
+    # Se escribe en un temporal con la misma extensión y se renombra al terminar,
+    # así un archivo a medio escribir nunca tiene el nombre final
+    root, extension = os.path.splitext(path)
+    tmp_path = f"{root}.tmp{extension}"
+    try:
+      yield tmp_path
+      os.replace(tmp_path, path)
+    finally:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
   def has_file(self, directory):
     for root, dirs, files in os.walk(directory):
         if files:  # Si hay al menos un archivo en el directorio actual
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the pipeline are imported as in main.py, from src/download_process
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "download_process"))
@@ -0,0 +1,70 @@
+from cds_scheduler import CdsScheduler, CdsJob
+
+
+class FakeResult():
+  # Pasa por los estados dados en cada update, el último se repite
+  def __init__(self, states, error=None):
+    self.states = list(states)
+    self.error = error
+    self.reply = {"state": "accepted"}
+
+  def update(self):
+    self.reply = {"state": self.states.pop(0) if len(self.states) > 1 else self.states[0]}
+    if self.error is not None:
+      self.reply["error"] = self.error
+
+  def download(self, target):
+    with open(target, "w") as f:
+      f.write("zip")
+
+
+class FakeClient():
+
+  def __init__(self, results):
+    self.results = results
+
+  def retrieve(self, dataset, request):
+    result = self.results[request["name"]]
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+
+def run_jobs(tmp_path, results, on_complete=None, **kwargs):
+  errors = {}
+  jobs = [CdsJob("dataset", {"name": name}, str(tmp_path / f"{name}.zip"), on_complete=on_complete,
+                 on_error=lambda error, name=name: errors.setdefault(name, error))
+          for name in results]
+  scheduler = CdsScheduler(client_factory=lambda: FakeClient(results), poll_interval=0, **kwargs)
+  return {job.request["name"]: job for job in scheduler.run(jobs)}, errors
+
+
+def test_failures_are_recorded_and_do_not_stop_the_other_jobs(tmp_path):
+  def on_complete(target):
+    if target.endswith("extract.zip"):
+      raise ValueError("bad zip")
+
+  results = {
+      "ok": FakeResult(["queued", "running", "completed"]),
+      "submit": RuntimeError("request rejected"),
+      "failed": FakeResult(["running", "failed"], error="no data"),
+      "dismissed": FakeResult(["dismissed"]),
+      "extract": FakeResult(["completed"]),
+  }
+  jobs, errors = run_jobs(tmp_path, results, on_complete=on_complete)
+
+  assert jobs["ok"].state == "downloaded"
+  assert (tmp_path / "ok.zip").exists()
+  assert {name: job.state for name, job in jobs.items() if name != "ok"} == dict.fromkeys(errors, "failed")
+  assert errors == {"submit": "request rejected", "failed": "no data", "dismissed": "CDS request dismissed",
+                    "extract": "bad zip"}
+
+
+def test_jobs_not_done_before_max_wait_are_failed(tmp_path):
+  results = {"running": FakeResult(["running"]), "ok": FakeResult(["completed"]), "queued": FakeResult(["queued"])}
+  jobs, errors = run_jobs(tmp_path, results, max_requests=1, max_wait=0.2)
+
+  assert jobs["running"].state == "failed"
+  assert jobs["ok"].state == "failed" and jobs["queued"].state == "failed"
+  assert set(errors) == {"running", "ok", "queued"}
+  assert "not completed" in errors["ok"]
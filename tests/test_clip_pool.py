@@ -0,0 +1,58 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+import xarray as xr
+
+from clip_plan import ClipPlan
+from clip_pool import ClipPool, convert_netcdf, transform_values
+
+
+def make_dataset():
+  lat = np.arange(15, 10, -0.1)
+  lon = np.arange(-90, -85, 0.1)
+  ds = xr.Dataset(coords={"time": [pd.Timestamp("2024-07-01")], "lat": lat, "lon": lon})
+  ds["v"] = (("time", "lat", "lon"), np.full((1, len(lat), len(lon)), 2.5e7, dtype=np.float32))
+  return ds
+
+
+def convert(ds):
+  return (transform_values(ds, "/", 1000000)["v"].dtype,
+          transform_values(ds, "-", 273.15)["v"].dtype,
+          transform_values(ds["v"], "/", 1000000).dtype)
+
+
+def test_transform_keeps_float32_in_main_thread():
+  assert convert(make_dataset()) == (np.float32, np.float32, np.float32)
+
+
+def test_transform_keeps_float32_in_worker_thread():
+  # The sources run in a ThreadPoolExecutor in main.py
+  with ThreadPoolExecutor(max_workers=1) as executor:
+    assert executor.submit(convert, make_dataset()).result() == (np.float32, np.float32, np.float32)
+
+
+def test_transform_keeps_the_order_of_the_variables():
+  # convert_netcdf takes the variable of AgERA5 by its position
+  ds = make_dataset()
+  assert list(transform_values(ds, "/", 1000000).variables) == list(ds.variables)
+
+
+def test_srad_is_float32_with_one_or_more_processes(tmp_path):
+  # --processes 1 runs the conversion in the calling process, N in spawned workers
+  ds = make_dataset()
+  ds.lat.attrs["standard_name"] = "latitude"
+  ds.lon.attrs["standard_name"] = "longitude"
+  ds.to_netcdf(tmp_path / "srad.nc")
+  plan = ClipPlan(str(tmp_path / "country.shp"))
+  for processes in [1, 2]:
+    tasks = [(str(tmp_path / "srad.nc"), str(tmp_path / f"srad_{processes}_{i}.tif"), "/", 1000000) for i in range(2)]
+    pool = ClipPool(plan, processes)
+    try:
+      for output_file, _ in pool.map(convert_netcdf, tasks):
+        with rasterio.open(output_file) as src:
+          assert src.dtypes[0] == "float32"
+          assert np.allclose(src.read(1), 25)
+    finally:
+      pool.close()
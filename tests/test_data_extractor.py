@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pyarrow.dataset as ds
+import rasterio
+from affine import Affine
+
+from tools import Tools
+from data_extractor import DataExtractor
+
+
+def extract(output_path, start_date, end_date, value):
+  extractor = DataExtractor(str(output_path), None, start_date, end_date, output_format="parquet")
+  dates = Tools().generate_dates(start_date, end_date)
+  data = {
+      'day': [int(date[8:10]) for date in dates],
+      'month': [int(date[5:7]) for date in dates],
+      'year': [int(date[0:4]) for date in dates]
+  }
+  for variable in extractor.variables:
+    data[variable] = np.full((len(dates), 2), value, dtype=np.float32)
+  extractor.save_to_parquet(["A", "B"], data)
+  return extractor.parquet_path
+
+
+def test_parquet_overlapping_runs_do_not_duplicate_days(tmp_path):
+  extract(tmp_path, "2024-07", "2024-07", 1.0)
+  parquet_path = extract(tmp_path, "2024-07", "2024-08", 2.0)
+
+  table = ds.dataset(parquet_path, format="parquet", partitioning="hive").to_table().to_pandas()
+  assert len(table) == 2 * (31 + 31)
+  assert not table.duplicated(["id", "date"]).any()
+  # Los días de julio son los de la última corrida
+  assert (table["t_max"] == 2.0).all()
+
+
+def write_raster(output_path, variable, date_str, value):
+  folder = os.path.join(output_path, variable)
+  os.makedirs(folder, exist_ok=True)
+  raster_file = os.path.join(folder, f"{variable}_{date_str}.tif")
+  with rasterio.open(raster_file, "w", driver="GTiff", height=10, width=10, count=1, dtype="float32",
+                     crs="EPSG:4326", transform=Affine(0.1, 0, -76, 0, -0.1, 5)) as dest:
+    dest.write(np.full((1, 10, 10), value, dtype=np.float32))
+  return raster_file
+
+
+def test_cube_falls_back_to_rasters_for_days_not_in_the_cube(tmp_path):
+  # El 1 de julio está en el cubo, el 2 solo como raster (recortado antes de --cube)
+  extractor = DataExtractor(str(tmp_path), None, "2024-07", "2024-07", country="TEST", cube=True)
+  extractor.cube.append_rasters([write_raster(tmp_path, "PREC", "20240701", 5.0)])
+  write_raster(tmp_path, "PREC", "20240702", 1.0)
+
+  data, outside = extractor.extract_raster_data("2024-07", "2024-07", [-75.55], [4.55], variables=["prec"])
+  assert data["prec"][0, 0] == 5.0
+  assert data["prec"][1, 0] == 1.0
+  assert np.isnan(data["prec"][2, 0])
+  assert not outside["prec"][0]
@@ -0,0 +1,122 @@
+import http.server
+import os
+import threading
+
+import pytest
+
+from chirps_data import ChirpsData
+from downloader import Downloader
+
+DATA = bytes(range(256)) * 8
+
+
+class FakeFiles(http.server.BaseHTTPRequestHandler):
+  # Sirve DATA con Range, 416 cuando el rango empieza al final del archivo
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def send(self, status, body=b"", headers=None):
+    self.send_response(status)
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_HEAD(self):
+    self.server.requests.append(("HEAD", self.path, None))
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(DATA)))
+    self.end_headers()
+
+  def do_GET(self):
+    range_header = self.headers.get("Range")
+    self.server.requests.append(("GET", self.path, range_header))
+    if self.path != "/file.bin":
+      return self.send(404)
+    if range_header is None:
+      return self.send(200, DATA)
+
+    start = int(range_header[len("bytes="):-1])
+    if start >= len(DATA):
+      headers = {"Content-Range": f"bytes */{len(DATA)}"} if self.server.content_range else {}
+      return self.send(416, headers=headers)
+    self.send(206, DATA[start:], {"Content-Range": f"bytes {start}-{len(DATA) - 1}/{len(DATA)}"})
+
+
+@pytest.fixture
+def server():
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeFiles)
+  server.requests = []
+  server.content_range = True
+  server.url = f"http://127.0.0.1:{server.server_port}"
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+
+def download(server, tmp_path, part=None, name="file.bin"):
+  path = str(tmp_path / "file.bin")
+  if part is not None:
+    with open(f"{path}.part", "wb") as f:
+      f.write(part)
+  downloader = Downloader(workers=1, retries=2, backoff=0)
+  try:
+    return path, downloader.download(f"{server.url}/{name}", path)
+  finally:
+    downloader.close()
+
+
+def read(path):
+  with open(path, "rb") as f:
+    return f.read()
+
+
+def test_resumes_the_part_file_with_a_range_request(server, tmp_path):
+  path, response = download(server, tmp_path, part=DATA[:500])
+  assert response.error is None and response.res == path
+  assert read(path) == DATA
+  assert not os.path.exists(f"{path}.part")
+  assert server.requests == [("GET", "/file.bin", "bytes=500-")]
+
+
+def test_complete_part_file_is_promoted_on_416(server, tmp_path):
+  path, response = download(server, tmp_path, part=DATA)
+  assert response.error is None
+  assert read(path) == DATA
+  assert server.requests == [("GET", "/file.bin", f"bytes={len(DATA)}-")]
+
+
+@pytest.mark.parametrize("content_range", [True, False])
+def test_part_file_of_another_size_is_downloaded_again_on_416(server, tmp_path, content_range):
+  # Sin Content-Range el tamaño se pide con HEAD
+  server.content_range = content_range
+  path, response = download(server, tmp_path, part=DATA + b"stale")
+  assert response.error is None
+  assert read(path) == DATA
+  assert server.requests[-1] == ("GET", "/file.bin", None)
+  assert (("HEAD", "/file.bin", None) in server.requests) != content_range
+
+
+def test_missing_file_is_not_retried(server, tmp_path):
+  path, response = download(server, tmp_path, name="missing.bin")
+  assert response.error is not None and "404" in response.error
+  assert server.requests == [("GET", "/missing.bin", None)]
+  assert not os.path.exists(path)
+
+
+def test_chirps_closes_the_downloader_session(tmp_path, monkeypatch):
+  chirps = ChirpsData(str(tmp_path / "outputs"), "TEST", "2024-07", "2024-07", str(tmp_path / "download"))
+  closed = []
+  monkeypatch.setattr(chirps.downloader, "close", lambda: closed.append(True))
+
+  def run():
+    raise RuntimeError("download failed")
+
+  monkeypatch.setattr(chirps, "run", run)
+  with pytest.raises(RuntimeError):
+    chirps.main()
+  assert closed == [True]
@@ -0,0 +1,83 @@
+import http.server
+import threading
+
+import pytest
+
+from geoserver_conexion.geoserver import GeoserverImport
+
+
+class FakeRest(http.server.BaseHTTPRequestHandler):
+  # Keep-alive, como el Geoserver real
+  protocol_version = "HTTP/1.1"
+  responses = {
+      "/geoserver/rest/workspaces.xml": "<workspaces><workspace><name>ws</name></workspace></workspaces>",
+      "/geoserver/rest/workspaces/ws/coveragestores.xml":
+          "<coverageStores><coverageStore><name>PREC</name></coverageStore><coverageStore><name>TMAX</name></coverageStore></coverageStores>",
+      "/geoserver/rest/workspaces/ws/datastores.xml": "<dataStores/>",
+      "/geoserver/rest/workspaces/ws/wmsstores.xml": "<wmsStores/>",
+  }
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, status, body=""):
+    body = body.encode()
+    self.send_response(status)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    self.server.requests.append(("GET", self.path, self.client_address))
+    if self.path in self.responses:
+      self.reply(200, self.responses[self.path])
+    else:
+      self.reply(404)
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    self.server.requests.append(("POST", self.path, self.client_address))
+    self.reply(202)
+
+
+@pytest.fixture
+def geoserver():
+  server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeRest)
+  server.requests = []
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server
+  server.shutdown()
+  server.server_close()
+
+
+def test_upload_reuses_connections_and_store_lookups(geoserver, tmp_path):
+  rasters = {}
+  for layer in ["PREC", "TMAX"]:
+    rasters[layer] = []
+    for day in range(1, 4):
+      raster_file = tmp_path / f"{layer}_2024070{day}.tif"
+      raster_file.write_bytes(b"raster")
+      rasters[layer].append(str(raster_file))
+
+  # Un raster por lote: tres lotes por store
+  geoserver_import = GeoserverImport("ws", "user", "pass", f"http://127.0.0.1:{geoserver.server_port}/geoserver/",
+                                     max_batch_bytes=1, max_uploads=2, zip_path=str(tmp_path))
+  landed = geoserver_import.connect_geoserver(rasters)
+  assert landed == rasters
+
+  posts = [request for request in geoserver.requests if request[0] == "POST"]
+  assert len(posts) == 6
+  # Las conexiones del pool se reutilizan entre lotes: a lo sumo una por carga más la del catálogo
+  connections = set(address for _, _, address in geoserver.requests)
+  assert len(connections) <= geoserver_import.max_uploads + 1
+
+  # Los stores se leen una sola vez para todos los lotes, hasta forget_stores
+  store_lookups = lambda: sum(1 for _, path, _ in geoserver.requests if path.endswith("/coveragestores.xml"))
+  assert store_lookups() == 1
+  client = geoserver_import.client
+  assert client.get_store("PREC") is not None
+  assert store_lookups() == 1
+  client.forget_stores()
+  assert client.get_store("PREC") is not None
+  assert store_lookups() == 2
+  client.session.close()
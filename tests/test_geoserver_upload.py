@@ -0,0 +1,54 @@
+import json
+import time
+
+from geoserver_upload import UploadGeoserver
+
+
+def make_upload(output_path, monkeypatch, reconcile=False):
+  monkeypatch.setenv("GEO_URL", "http://geoserver.test/geoserver/")
+  upload = UploadGeoserver(str(output_path), "TEST", "2024-07", "2024-07", "aclimate", reconcile=reconcile)
+  calls = []
+
+  def fetch_time_index():
+    calls.append(1)
+    return {"PREC": ["2024-07-01"], "TMAX": ["2024-07-01"]}
+
+  upload.fetch_time_index = fetch_time_index
+  return upload, calls
+
+
+def test_reconcile_uses_the_cached_time_index(tmp_path, monkeypatch):
+  raster_file = tmp_path / "PREC_20240701.tif"
+  raster_file.write_bytes(b"raster")
+  upload, calls = make_upload(tmp_path, monkeypatch)
+  upload.reconcile_ledger({"PREC": {}})
+  assert len(calls) == 1
+  assert json.load(open(tmp_path / "geoserver_time_index.json"))
+
+  # Otra corrida dentro de time_index_max_age lee el índice guardado
+  upload, calls = make_upload(tmp_path, monkeypatch)
+  upload.reconcile_ledger({"PREC": {"2024-07-01": str(raster_file)}})
+  assert calls == []
+  assert upload.ledger.dates("PREC") == {"2024-07-01"}
+
+
+def test_reconcile_refreshes_an_old_time_index(tmp_path, monkeypatch):
+  upload, calls = make_upload(tmp_path, monkeypatch)
+  upload.reconcile_ledger({"PREC": {}})
+  upload.time_index["fetched"] = time.time() - upload.time_index_max_age - 1
+  upload.save_time_index()
+
+  upload, calls = make_upload(tmp_path, monkeypatch)
+  upload.reconcile_ledger({"PREC": {}})
+  assert len(calls) == 1
+
+
+def test_time_index_is_fetched_once_per_run(tmp_path, monkeypatch):
+  # main se llama una vez por fuente, cada una con sus capas
+  for reconcile in [False, True]:
+    output_path = tmp_path / str(reconcile)
+    output_path.mkdir()
+    upload, calls = make_upload(output_path, monkeypatch, reconcile=reconcile)
+    upload.reconcile_ledger({"PREC": {}})
+    upload.reconcile_ledger({"TMAX": {}})
+    assert len(calls) == 1
@@ -0,0 +1,36 @@
+import threading
+import time
+
+from manifest import Manifest
+
+
+def test_add_does_not_change_the_files_while_the_lock_is_taken(tmp_path):
+  # save recorre los sets con el lock, un add de los hilos de recorte no puede cambiarlos mientras tanto
+  folder = str(tmp_path / "PREC")
+  (tmp_path / "PREC").mkdir()
+  manifest = Manifest(str(tmp_path / "manifest.json"))
+  manifest.files(folder)
+
+  # El add se detiene justo después de buscar el set del directorio
+  files = manifest.files
+  looked_up = threading.Event()
+
+  def slow_files(directory):
+    result = files(directory)
+    looked_up.set()
+    time.sleep(0.2)
+    return result
+
+  manifest.files = slow_files
+  thread = threading.Thread(target=manifest.add, args=(f"{folder}/PREC_20240701.tif",))
+  thread.start()
+  looked_up.wait()
+
+  with manifest.lock:
+    before = set(manifest.directories[folder])
+    time.sleep(0.4)
+    assert manifest.directories[folder] == before
+  thread.join()
+
+  assert files(folder) == {"PREC_20240701.tif"}
+  assert manifest.dates(folder) == {"20240701"}